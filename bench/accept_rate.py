@@ -0,0 +1,106 @@
+'''
+链接建立速率基准测试，对比逐个accept(旧行为)与批量accept
+
+用法(在项目根目录下执行): python -m bench.accept_rate [并发链接数] [轮数]
+'''
+import logging
+import os, sys
+import time
+import signal
+import selectors, socket
+import server.nioserver as nioserver
+
+PORT = 18765
+
+class AcceptHandler:
+    '''
+    链接后立即写一个字节并关闭，客户端收到EOF即视为链接建立完成
+    '''
+    def connect(self, session):
+        session.write(b'.')
+        session.close()
+    def recv(self, session, data):
+        pass
+    def close(self, session):
+        pass
+    def hup(self, session):
+        pass
+    def error(self, session):
+        pass
+    def timeout(self, session):
+        pass
+
+def start_server(listen_backlog, accept_batch):
+    pid = os.fork()
+    if pid == 0:
+        os.setsid()
+        server = nioserver.NIOServer(address=('127.0.0.1', PORT), nr_processors=1,
+                        listen_backlog=listen_backlog, accept_batch=accept_batch,
+                        sockopts=((socket.SOL_SOCKET, socket.SO_REUSEADDR, 1),),
+                        handler=AcceptHandler())
+        server.start()
+        os._exit(0)
+    time.sleep(0.5)
+    return pid
+
+def stop_server(pid):
+    os.killpg(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+
+def storm(nr_connections):
+    '''
+    同时发起nr_connections个非阻塞链接，返回全部完成所用秒数和失败数
+    '''
+    selector = selectors.DefaultSelector()
+    begin = time.perf_counter()
+    for i in range(nr_connections):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(False)
+        s.connect_ex(('127.0.0.1', PORT))
+        selector.register(s, selectors.EVENT_READ)
+    remain = nr_connections
+    failed = 0
+    while remain:
+        events = selector.select(10)
+        if not events:
+            failed += remain
+            break
+        for key, mask in events:
+            try:
+                while key.fileobj.recv(1024):
+                    pass
+            except BlockingIOError:
+                continue
+            except OSError:
+                failed += 1
+            selector.unregister(key.fileobj)
+            key.fileobj.close()
+            remain -= 1
+    elapsed = time.perf_counter() - begin
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    selector.close()
+    return elapsed, failed
+
+def main():
+    logging.basicConfig(level=logging.CRITICAL) # 链接风暴下的链接错误日志会干扰测试结果
+    nr_connections = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    cases = (
+        ('旧行为 backlog=5 batch=1', 5, 1),
+        ('backlog=%d batch=1' % nioserver.NIOServer.DEFAULT_LISTEN_BACKLOG, nioserver.NIOServer.DEFAULT_LISTEN_BACKLOG, 1),
+        ('默认 backlog=%d batch=%d' % (nioserver.NIOServer.DEFAULT_LISTEN_BACKLOG, nioserver.NIOServer.DEFAULT_ACCEPT_BATCH), nioserver.NIOServer.DEFAULT_LISTEN_BACKLOG, nioserver.NIOServer.DEFAULT_ACCEPT_BATCH),
+    )
+    for name, listen_backlog, accept_batch in cases:
+        pid = start_server(listen_backlog, accept_batch)
+        try:
+            results = [storm(nr_connections) for i in range(rounds)]
+        finally:
+            stop_server(pid)
+        best = min(r[0] for r in results)
+        worst = max(r[0] for r in results)
+        failed = sum(r[1] for r in results)
+        print('%-36s %8.0f conn/s (最快 %.3fs, 最慢 %.3fs, 失败 %d)' % (name, nr_connections / best, best, worst, failed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''
+请求解码基准测试，浏览器的典型请求头分别一次到达、按小块分多次到达时，wsgiserver.parse_request每个请求的耗时
+
+用法(在项目根目录下执行): python -m bench.parse_request [每种情况的请求数]
+'''
+import sys
+import timeit
+import server.wsgiserver as wsgiserver
+
+# Chrome访问后台页面时的请求头，带登录后的Cookie
+BROWSER_REQUEST = (
+    b'GET /group/list?page=2&size=20 HTTP/1.1\r\n'
+    b'Host: 192.168.1.20:8000\r\n'
+    b'Connection: keep-alive\r\n'
+    b'Cache-Control: max-age=0\r\n'
+    b'sec-ch-ua: "Chromium";v="124", "Google Chrome";v="124", "Not-A.Brand";v="99"\r\n'
+    b'sec-ch-ua-mobile: ?0\r\n'
+    b'sec-ch-ua-platform: "Windows"\r\n'
+    b'Upgrade-Insecure-Requests: 1\r\n'
+    b'User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36\r\n'
+    b'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7\r\n'
+    b'Sec-Fetch-Site: same-origin\r\n'
+    b'Sec-Fetch-Mode: navigate\r\n'
+    b'Sec-Fetch-User: ?1\r\n'
+    b'Sec-Fetch-Dest: document\r\n'
+    b'Referer: http://192.168.1.20:8000/group/list?page=1&size=20\r\n'
+    b'Accept-Encoding: gzip, deflate\r\n'
+    b'Accept-Language: zh-CN,zh;q=0.9,en;q=0.8\r\n'
+    b'Cookie: PSESSIONID=3f9c2a7e5b1d4c8a9e6f0b2d7a4c1e8f; Hm_lvt_8a2c4e6f=1714012345,1714098765; theme=dark; last_group=17\r\n'
+    b'\r\n'
+)
+
+class FakeSession:
+    '''
+    只实现parse_request用到的Session接口
+    '''
+    def __init__(self):
+        self.attributes = {}
+    def set_timeout(self, timeout, absolute=False):
+        pass
+    def write(self, data):
+        raise AssertionError('请求被拒绝: %r' % data)
+    def close(self):
+        raise AssertionError('链接被关闭')
+
+def decode_all(session, chunks):
+    for chunk in chunks:
+        requests = wsgiserver.parse_request(session, memoryview(chunk))
+        if requests:
+            return requests
+    raise AssertionError('请求不完整')
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print('请求头%d字节' % len(BROWSER_REQUEST))
+    cases = [('一次到达', [BROWSER_REQUEST])]
+    for size in (512, 64):
+        cases.append(('每次%d字节' % size, [BROWSER_REQUEST[i:i + size] for i in range(0, len(BROWSER_REQUEST), size)]))
+    for name, chunks in cases:
+        request = decode_all(FakeSession(), chunks)[0]
+        assert request.path == '/group/list?page=2&size=20' and len(request.headers) == 17, request.headers
+        best = min(timeit.repeat(lambda: decode_all(FakeSession(), chunks), number=n, repeat=5))
+        print('%-12s %3d次recv %8.1f us/请求' % (name, len(chunks), best / n * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+'''
+热路径日志开关与二进制跟踪的开销基准测试
+1. 单次调用：未加开关的logging.debug(旧写法)、加开关的logging.debug、TRACER.record
+2. 端到端：HTTP keep-alive请求在不同日志级别、跟踪开关下每个请求的耗时
+
+用法(在项目根目录下执行): python -m bench.trace_overhead [请求数] [并发链接数] [轮数]
+'''
+import logging
+import os, sys
+import time
+import timeit
+import signal
+import selectors, socket
+import tempfile
+import server.nioserver as nioserver
+import server.wsgiserver as wsgiserver
+import server.trace as trace
+
+PORT = 18766
+REQUEST = b'GET /ping HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'
+
+def application(environ, start_response):
+    start_response('200 OK', {'Content-Type': 'text/plain', 'Content-Length': '2'})
+    return b'ok'
+
+def micro():
+    client_address = ('127.0.0.1', 54321)
+    logging.getLogger().setLevel(logging.WARNING)
+    nioserver.update_log_guards()
+    with tempfile.TemporaryDirectory() as path:
+        tracer = trace.Tracer(os.path.join(path, 'trace'), 4096)
+        cases = (
+            ('logging.debug 未加开关(旧写法)', lambda: logging.debug('向客户端[%s:%d]写数据' % client_address)),
+            ('logging.debug 加开关', lambda: nioserver.LOG_DEBUG and logging.debug('向客户端[%s:%d]写数据' % client_address)),
+            ('TRACER.record', lambda: tracer.record(trace.TRACE_WRITE, 10, 128)),
+        )
+        n = 200000
+        for name, statement in cases:
+            best = min(timeit.repeat(statement, number=n, repeat=5))
+            print('%-32s %8.1f ns/次' % (name, best / n * 1e9))
+        tracer.close()
+
+def start_server(port, level, trace_file):
+    pid = os.fork()
+    if pid == 0:
+        os.setsid()
+        # DEBUG级别时日志写到/dev/null，只计格式化和处理的开销，不计磁盘
+        logging.basicConfig(level=level, filename=os.devnull)
+        server = nioserver.NIOServer(address=('127.0.0.1', port), nr_processors=1, exec_nr_threads=4,
+                        sockopts=((socket.SOL_SOCKET, socket.SO_REUSEADDR, 1),),
+                        decode=wsgiserver.parse_request,
+                        handler=wsgiserver.HttpHandler(application, {'SERVER_PROTOCOL': wsgiserver.SERVER_PROTOCOL_VERSION}),
+                        trace_file=trace_file)
+        server.start()
+        os._exit(0)
+    time.sleep(0.5)
+    return pid
+
+def stop_server(pid):
+    os.killpg(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+
+def load(port, nr_requests, nr_connections):
+    '''
+    nr_connections个keep-alive链接轮流发送请求，每个链接收到完整响应后再发下一个，返回总秒数
+    '''
+    selector = selectors.DefaultSelector()
+    remain = {}
+    for i in range(nr_connections):
+        s = socket.create_connection(('127.0.0.1', port))
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        selector.register(s, selectors.EVENT_READ)
+        remain[s] = nr_requests // nr_connections
+    begin = time.perf_counter()
+    for s in remain:
+        s.sendall(REQUEST)
+    pending = len(remain)
+    while pending:
+        for key, mask in selector.select(10):
+            s = key.fileobj
+            data = s.recv(65536)
+            # 响应很小，每次recv正好是一个完整响应(以ok结尾)
+            if not data.endswith(b'ok'):
+                continue
+            remain[s] -= 1
+            if remain[s]:
+                s.sendall(REQUEST)
+            else:
+                pending -= 1
+    elapsed = time.perf_counter() - begin
+    for s in remain:
+        selector.unregister(s)
+        s.close()
+    selector.close()
+    return elapsed
+
+def main():
+    nr_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    nr_connections = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    print('== 单次调用 ==')
+    micro()
+    print('== 端到端 %d个请求, %d个链接 ==' % (nr_requests, nr_connections))
+    with tempfile.TemporaryDirectory() as path:
+        cases = (
+            ('WARNING, 不跟踪', logging.WARNING, None),
+            ('WARNING, 跟踪', logging.WARNING, os.path.join(path, 'trace')),
+            ('DEBUG(entry.py默认), 不跟踪', logging.DEBUG, None),
+        )
+        # 各情况同时启动，轮流测试，减少机器负载波动对比较的影响
+        pids = [start_server(PORT + i, level, trace_file) for i, (name, level, trace_file) in enumerate(cases)]
+        results = [[] for case in cases]
+        try:
+            for i in range(len(cases)):
+                load(PORT + i, nr_requests // 10, nr_connections) # 预热
+            for r in range(rounds):
+                for i in range(len(cases)):
+                    results[i].append(load(PORT + i, nr_requests, nr_connections))
+        finally:
+            [stop_server(pid) for pid in pids]
+        baseline = None
+        for (name, level, trace_file), elapsed in zip(cases, results):
+            per_request = sorted(elapsed)[len(elapsed) // 2] / nr_requests * 1e6 # 中位数
+            if baseline is None:
+                baseline = per_request
+            print('%-32s %8.0f req/s %8.1f us/请求 (%+.1f us)' % (name, 1e6 / per_request, per_request, per_request - baseline))
+
+if __name__ == '__main__':
+    main()
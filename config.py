@@ -11,3 +11,6 @@ cookie_path = '/'
 cookie_domain = 'panzx.com'
 
 site_name = '梓萱家园'
+
+static_root = install_path
+static_paths = ('/css/', '/js/', '/fonts/', '/images/', '/favicon.ico') # 静态文件的请求路径，以/结尾的是目录
@@ -25,6 +25,9 @@ def post(request, response):
 
 @authorization.protected(name='组列表', allow_roles=('SYS_USER',))
 def list(request, response):
+    # 数据未修改时返回304，不查询也不渲染
+    if webutil.check_not_modified(request, response, pzx.group.version()):
+        return
     data = {'title': '系统管理 - 组 - 列表'}
     page = request.get_param('page')
     size = request.get_param('size')
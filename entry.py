@@ -1,9 +1,16 @@
 import logging
+import os
+import hashlib
 import io
 import re
 import urllib
 from server.wsgiserver import HTTPServer
+from server.nioserver import RETIRING_ENV
+import server.logpipe as logpipe
 import dispatcher
+import multipart
+import static
+import webutil
 import config
 
 class Request:
@@ -15,6 +22,7 @@ class Request:
         [self.__headers.update({re.sub('^HTTP_', '', e).upper(): environs[e]}) for e in environs if e.startswith('HTTP_')]
         self.__environs = environs
         self.__params = None
+        self.__files = None # {字段名: [multipart.UploadFile]}，解析参数时一起生成
         self.__input = environs.get('wsgi.input')
         self.__encoding = encoding
         
@@ -66,6 +74,27 @@ class Request:
             self.__build_params()
         return self.__params.copy()
     
+    def get_file(self, name):
+        files = self.get_files(name)
+        return files[0] if files is not None else None
+        
+    def get_files(self, name, default=None):
+        if self.__params is None:
+            self.__build_params()
+        return self.__files[name] if name in self.__files else default
+        
+    def get_all_files(self):
+        if self.__params is None:
+            self.__build_params()
+        return self.__files.copy()
+    
+    def close(self):
+        '''
+        删除上传文件的临时文件
+        '''
+        if self.__files:
+            [upload.close() for uploads in self.__files.values() for upload in uploads]
+    
     def get_cookies(self):
         cookies = {}
         cookie = self.get_header('COOKIE')
@@ -86,13 +115,20 @@ class Request:
         
     def __build_params(self):
         self.__params = {}
+        self.__files = {}
         self.__parse_params(self.get_query_string().strip())
         if self.get_content_length() > 0:
             if not self.get_content_type().startswith('multipart/form-data'):
-                self.__parse_params(self.__input.getvalue().decode(self.__encoding).strip())
+                self.__parse_params(self.__input.read().decode(self.__encoding).strip())
             else:
-                # 比较难搞，以后实现
-                pass
+                # 按块读取请求体边读边解析，文件超过阈值后写入临时文件，不把整个请求体读入内存
+                boundary = multipart.get_boundary(self.get_content_type())
+                if not boundary:
+                    raise multipart.MultipartException('Content-Type缺少boundary')
+                parser = multipart.parse(self.__input, boundary, self.get_content_length(), self.__encoding)
+                [self.__put_value(name, value) for name, value in parser.fields]
+                for upload in parser.files:
+                    self.__files.setdefault(upload.name, []).append(upload)
                 
     def __parse_params(self, str):
         if not str:
@@ -103,7 +139,9 @@ class Request:
         name = kv[0].strip()
         if not name:
             return
-        value = urllib.parse.unquote(kv[1].strip())
+        self.__put_value(name, urllib.parse.unquote(kv[1].strip()))
+        
+    def __put_value(self, name, value):
         if name in self.__params:
             self.__params[name].append(value)
         else:
@@ -218,48 +256,62 @@ class Response:
     def get_cookies(self):
         return self.__cookies[:]
 
+@static.mount(config.static_root, config.static_paths, config.ctx_path)
 def application(env, start_response):
     request = Request(env, config.encoding)
-    out = io.BytesIO()
-    response = Response(out, config.encoding)
     try:
-        dispatcher.dispatch(request, response)
-    except Exception as e:
-        start_response('%d %s' % (500, 'Internal Server Error'), {})
-    else:
-        headers = response.get_headers()
-        cookies = response.get_cookies()
-        if cookies:
-            cookien = 0
-            cookiev = ''
-            for cookie in response.get_cookies():
-                if cookien > 0:
-                    cookiev = cookiev + '\r\nSet-Cookie: '
-                cookiev = cookiev + ('%s=%s' % (cookie[0], str(cookie[1])))
-                if (cookie[2]):
-                    cookiev = cookiev + ('; path=%s' % cookie[2])
-                if (cookie[3]):
-                    cookiev = cookiev + ('; domain=%s' % cookie[3])
-                if (cookie[4]):
-                    cookiev = cookiev + ('; expires=%s' % str(cookie[4]))
-                if (cookie[5]):
-                    cookiev = cookiev + ('; comment=%s' % cookie[5])
-                if (cookie[6]):
-                    cookiev = cookiev + ('; version=%s' % str(cookie[6]))
-                if (cookie[7]):
-                    cookiev = cookiev + ('; [secure]')
-                cookien = cookien + 1
-            headers['Set-Cookie'] = cookiev
-        write = start_response('%d %s' % response.get_status(), headers)
-        content = out.getvalue()
-        if content:
-            write(content)
+        out = io.BytesIO()
+        response = Response(out, config.encoding)
+        try:
+            dispatcher.dispatch(request, response)
+        except Exception as e:
+            start_response('%d %s' % (500, 'Internal Server Error'), {})
+        else:
+            headers = response.get_headers()
+            cookies = response.get_cookies()
+            if cookies:
+                cookien = 0
+                cookiev = ''
+                for cookie in response.get_cookies():
+                    if cookien > 0:
+                        cookiev = cookiev + '\r\nSet-Cookie: '
+                    cookiev = cookiev + ('%s=%s' % (cookie[0], str(cookie[1])))
+                    if (cookie[2]):
+                        cookiev = cookiev + ('; path=%s' % cookie[2])
+                    if (cookie[3]):
+                        cookiev = cookiev + ('; domain=%s' % cookie[3])
+                    if (cookie[4]):
+                        cookiev = cookiev + ('; expires=%s' % str(cookie[4]))
+                    if (cookie[5]):
+                        cookiev = cookiev + ('; comment=%s' % cookie[5])
+                    if (cookie[6]):
+                        cookiev = cookiev + ('; version=%s' % str(cookie[6]))
+                    if (cookie[7]):
+                        cookiev = cookiev + ('; [secure]')
+                    cookien = cookien + 1
+                headers['Set-Cookie'] = cookiev
+            content = out.getbuffer() # 不复制缓冲，超过阈值的页面由服务器边发送边反压
+            status = response.get_status()
+            if status[0] == 200 and request.get_method() in ('GET', 'HEAD') and 'ETag' not in headers:
+                # 处理器没有给出版本时以最终响应体的摘要作为ETag，页面不变时省去发送
+                headers['ETag'] = '"%s"' % hashlib.md5(content).hexdigest()
+                headers.setdefault('Cache-Control', 'private, no-cache')
+                if webutil.is_not_modified(request, headers['ETag']):
+                    status = (304, Response.RESPONSES[304])
+            if status[0] == 304:
+                content = b''
+                headers.pop('Content-Type', None)
+            elif 'Content-Length' not in headers:
+                headers['Content-Length'] = str(len(content)) # 长度已知，大页面也不必用chunked编码
+            write = start_response('%d %s' % status, headers)
+            if content:
+                write(content)
+    finally:
+        request.close() # 删除上传文件的临时文件
 
 if __name__ == '__main__':
 
-    logging.basicConfig(level=logging.DEBUG, 
-                format='%(threadName)s %(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s', 
-                datefmt='%Y-%m-%d %H:%M:%S',
-                file=config.log_file,
-                filemode='w')
+    # 异步写日志，Fork出的IO处理进程各自追加写config.log_file
+    # SIGHUP重启时旧IO处理进程还在写日志，只有冷启动才清空日志文件
+    logpipe.install(config.log_file, level=logging.DEBUG, mode='a' if RETIRING_ENV in os.environ else 'w')
     HTTPServer(config.port, application).start()
\ No newline at end of file
@@ -6,6 +6,7 @@ import security.authholder as authholder
 from security.authentication import AuthenticationException
 from security.authorization import AuthorizationException, UnAuthenticationException
 import webutil
+import multipart
 	
 referer_key = 'referer'
 redirect_key = 'redirect'
@@ -20,6 +21,10 @@ def exception(pattern=None):
         def wrap(request, response):
             try:
                 return func(request, response)
+            except multipart.MultipartException as e:
+                # 上传的请求体格式错误是客户端的问题，不输出异常堆栈
+                logging.warning('客户端[%s]上传的请求体格式错误: %s' % (request.get_remote_addr(), e))
+                handle(e, request, response)
             except Exception as e:
                 logging.error(e)
                 traceback.print_exc()
@@ -65,6 +70,11 @@ def handle(e, request, response):
      
     if isinstance(e, AuthorizationException):
         status = 403
+    
+    # 上传的请求体格式错误
+    if isinstance(e, multipart.MultipartException):
+        status = 400
+        response.set_status(status)
         
     # 输出错误页面
     webutil.render('/error.html', {'status': status, 'message': message}, request, response)
@@ -0,0 +1,241 @@
+'''
+multipart/form-data的增量解析
+请求体按块传入feed()，每块解析完即丢弃，只保留可能是分隔符开头的尾部，内存占用与请求体大小无关
+普通字段保存为字符串，文件保存在SpooledTemporaryFile中，超过spool_size字节后写入临时文件
+'''
+import re
+import shutil
+import tempfile
+
+__all__ = ['MultipartParser', 'UploadFile', 'MultipartException', 'get_boundary']
+
+DEFAULT_SPOOL_SIZE = 1024 * 1024 # 上传的文件不超过该字节数时保存在内存中，超过后写入临时文件
+DEFAULT_MAX_HEADER_SIZE = 16 * 1024 # 每个部分头部的最大字节数
+DEFAULT_MAX_FIELD_SIZE = 1024 * 1024 # 普通字段的最大字节数，普通字段保存在内存中
+DEFAULT_MAX_PARTS = 1000 # 最多的部分数
+DEFAULT_BLOCK_SIZE = 64 * 1024 # 从请求体每次读取的字节数
+
+# 解析状态
+STATE_PREAMBLE = 0 # 第一个分隔符之前
+STATE_BOUNDARY = 1 # 分隔符之后，等待\r\n或结束的--
+STATE_HEADERS = 2 # 部分的头部
+STATE_BODY = 3 # 部分的内容
+STATE_DONE = 4 # 结束分隔符之后，忽略剩余数据
+
+PARAM_PATTERN = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+QUOTED_PAIR_PATTERN = re.compile(r'\\(.)')
+
+class MultipartException(Exception):
+    pass
+
+def parse_header_params(value):
+    '''
+    解析form-data; name="a"; filename="b"形式的头，返回(值, {参数名小写: 参数值})
+    '''
+    main, sep, rest = value.partition(';')
+    params = {}
+    for name, param in PARAM_PATTERN.findall(sep + rest):
+        param = param.strip()
+        if param.startswith('"') and param.endswith('"') and len(param) > 1:
+            param = QUOTED_PAIR_PATTERN.sub(r'\1', param[1:-1])
+        params[name.lower()] = param
+    return main.strip().lower(), params
+
+def get_boundary(content_type):
+    '''
+    Content-Type中的boundary，不是multipart/form-data或没有boundary时返回None
+    '''
+    value, params = parse_header_params(content_type)
+    if value != 'multipart/form-data':
+        return None
+    return params.get('boundary') or None
+
+class UploadFile:
+    '''
+    上传的文件，file已定位到开头
+    '''
+    def __init__(self, name, filename, content_type, headers, spool_size):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.headers = headers
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(spool_size)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def save(self, path):
+        '''
+        复制到path，不把整个文件读入内存
+        '''
+        self.file.seek(0)
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(self.file, f)
+        self.file.seek(0)
+
+    def close(self):
+        self.file.close() # 删除临时文件
+
+    def __str__(self):
+        return 'UploadFile [name=%s, filename=%s, size=%d]' % (self.name, self.filename, self.size)
+
+class Part:
+    '''
+    正在接收的部分，普通字段累积在内存中，文件写入UploadFile
+    '''
+    def __init__(self, name, upload, max_field_size):
+        self.name = name
+        self.upload = upload
+        self.max_field_size = max_field_size
+        self.value = bytearray()
+
+    def write(self, data):
+        if self.upload:
+            self.upload.file.write(data)
+            self.upload.size += len(data)
+            return
+        if len(self.value) + len(data) > self.max_field_size:
+            raise MultipartException('字段[%s]超过%d字节' % (self.name, self.max_field_size))
+        self.value += data
+
+class MultipartParser:
+
+    def __init__(self, boundary, encoding='UTF-8', spool_size=DEFAULT_SPOOL_SIZE, max_header_size=DEFAULT_MAX_HEADER_SIZE,
+                max_field_size=DEFAULT_MAX_FIELD_SIZE, max_parts=DEFAULT_MAX_PARTS):
+        if not boundary:
+            raise ValueError('参数[boundary]不能为空')
+        self.encoding = encoding
+        self.spool_size = spool_size
+        self.max_header_size = max_header_size
+        self.max_field_size = max_field_size
+        self.max_parts = max_parts
+        self.fields = [] # [(字段名, 值)]，按出现的顺序
+        self.files = [] # [UploadFile]，按出现的顺序
+        self.__delimiter = b'\r\n--' + boundary.encode('latin-1')
+        # 第一个分隔符前面可以没有\r\n，补上之后所有分隔符的形式相同
+        self.__buffer = bytearray(b'\r\n')
+        self.__state = STATE_PREAMBLE
+        self.__part = None
+        self.__nr_parts = 0
+
+    def feed(self, data):
+        self.__buffer += data
+        buffer = self.__buffer
+        delimiter = self.__delimiter
+        start = 0 # 未处理数据的开始位置，处理完一批之后再从缓冲中删除，避免反复移动数据
+        while True:
+            state = self.__state
+            if state == STATE_PREAMBLE or state == STATE_BODY:
+                index = buffer.find(delimiter, start)
+                if index < 0:
+                    # 尾部可能是分隔符的开头，留待下次
+                    keep = max(len(buffer) - len(delimiter) + 1, start)
+                    if state == STATE_BODY and keep > start:
+                        self.__part.write(buffer[start:keep])
+                    start = keep
+                    break
+                if state == STATE_BODY:
+                    self.__part.write(buffer[start:index])
+                    self.__finish_part()
+                start = index + len(delimiter)
+                self.__state = STATE_BOUNDARY
+            elif state == STATE_BOUNDARY:
+                if len(buffer) - start < 2:
+                    break
+                if buffer[start:start + 2] == b'--':
+                    self.__state = STATE_DONE
+                    start = len(buffer)
+                    break
+                # 分隔符之后到\r\n之间可以有空白
+                index = buffer.find(b'\r\n', start)
+                if index < 0:
+                    if len(buffer) - start > self.max_header_size:
+                        raise MultipartException('分隔符之后缺少换行')
+                    break
+                if buffer[start:index].strip(b' \t'):
+                    raise MultipartException('分隔符之后有多余的数据')
+                start = index + 2
+                self.__state = STATE_HEADERS
+            elif state == STATE_HEADERS:
+                if len(buffer) - start < 2:
+                    break
+                if buffer[start:start + 2] == b'\r\n':
+                    head = b'' # 没有头部，空行紧接在分隔符之后
+                    start += 2
+                else:
+                    index = buffer.find(b'\r\n\r\n', start)
+                    if index < 0:
+                        if len(buffer) - start > self.max_header_size:
+                            raise MultipartException('部分的头部超过%d字节' % self.max_header_size)
+                        break
+                    head = bytes(buffer[start:index])
+                    start = index + 4
+                self.__start_part(head)
+                self.__state = STATE_BODY
+            else:
+                start = len(buffer)
+                break
+        del buffer[:start]
+
+    def close(self):
+        '''
+        请求体已全部传入，没有结束分隔符时抛出MultipartException
+        '''
+        if self.__state != STATE_DONE:
+            raise MultipartException('请求体不完整')
+
+    def __start_part(self, head):
+        self.__nr_parts += 1
+        if self.__nr_parts > self.max_parts:
+            raise MultipartException('部分数超过%d' % self.max_parts)
+        headers = {}
+        for line in head.decode(self.encoding, 'replace').split('\r\n'):
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().upper()] = value.strip()
+        disposition, params = parse_header_params(headers.get('CONTENT-DISPOSITION', ''))
+        if disposition != 'form-data' or 'name' not in params:
+            raise MultipartException('部分缺少Content-Disposition: form-data; name')
+        upload = None
+        if 'filename' in params:
+            # IE等浏览器会带上客户端的完整路径
+            filename = re.split(r'[\\/]', params['filename'])[-1]
+            upload = UploadFile(params['name'], filename, headers.get('CONTENT-TYPE', 'application/octet-stream'), headers, self.spool_size)
+        self.__part = Part(params['name'], upload, self.max_field_size)
+
+    def __finish_part(self):
+        part = self.__part
+        self.__part = None
+        if part.upload:
+            part.upload.file.seek(0)
+            self.files.append(part.upload)
+        else:
+            self.fields.append((part.name, part.value.decode(self.encoding, 'replace')))
+
+    def abort(self):
+        '''
+        解析出错时关闭已创建的临时文件
+        '''
+        if self.__part and self.__part.upload:
+            self.__part.upload.close()
+        [upload.close() for upload in self.files]
+
+def parse(input, boundary, content_length, encoding='UTF-8', block_size=DEFAULT_BLOCK_SIZE, **options):
+    '''
+    从input按块读取content_length字节并解析，返回MultipartParser
+    '''
+    parser = MultipartParser(boundary, encoding, **options)
+    try:
+        remain = content_length
+        while remain > 0:
+            data = input.read(min(block_size, remain))
+            if not data:
+                break
+            remain -= len(data)
+            parser.feed(data)
+        parser.close()
+    except Exception:
+        parser.abort()
+        raise
+    return parser
@@ -1,6 +1,8 @@
 import sqlite3
 import config
 
+SQLITE_CHANGE_COUNTER_OFFSET = 24 # SQLite文件头中文件修改计数的偏移，4字节大端
+
 class DBTemplate:
     
     def __init__(self, database):
@@ -9,6 +11,16 @@ class DBTemplate:
     def __connect(self):
         return sqlite3.connect(self.__database)
 
+    def get_version(self):
+        '''
+        数据库的版本，任何进程提交修改后都会变化，用于判断查询结果是否可能已改变
+        回滚日志模式下每次提交修改SQLite都会增加文件头中的修改计数，只读文件头，不必打开数据库链接
+        WAL模式下提交只写WAL文件，检查点之前文件头不变，切换到WAL后版本不再随提交变化，不能再用这个方法判断数据是否修改
+        '''
+        with open(self.__database, 'rb') as f:
+            f.seek(SQLITE_CHANGE_COUNTER_OFFSET)
+            return int.from_bytes(f.read(4), 'big')
+
     def execute(self, action):
         conn = None
         try:
@@ -79,6 +79,12 @@ def get(id):
 def list():
     return __repo_list()
     
+def version():
+    '''
+    组数据的版本，组、角色和子组的任何修改都会使版本变化
+    '''
+    return db_template.get_version()
+
 def list_by_user(user_id):
     return __repo_find_by_user(user_id)
 
@@ -8,7 +8,8 @@ def set(authentication):
     authentication_local.authentication = authentication
 
 def get():
-    return authentication_local.authentication
+    # 登录验证等请求不经过authholder.set()，线程第一次处理这类请求时还没有该属性
+    return getattr(authentication_local, 'authentication', None)
 
 def principal():
     authentication = get()
@@ -0,0 +1,443 @@
+import asyncio
+import collections
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import server.nioserver as nioserver
+import server.trace as trace
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None # 没有安装uvloop时使用asyncio自带的事件循环
+
+__all__ = ['AIOServer']
+
+class AIOServer(nioserver.NIOServer):
+    '''
+    基于asyncio transport/protocol的服务器，可与NIOServer替换使用
+    多进程、服务端socket、decode、handler和Executor与NIOServer完全相同，只是IO处理进程中以asyncio事件循环代替Poller
+    poller、edge_triggered和接收缓冲相关的参数由事件循环自行处理，设置了也不起作用
+    服务端socket由本类accept后交给loop.connect_accepted_socket()，以便平滑退出时准确知道还有哪些链接尚未建立Protocol
+    '''
+    DEFAULT_USE_UVLOOP = True
+
+    def __init__(self, use_uvloop=DEFAULT_USE_UVLOOP, **options):
+        super().__init__(**options)
+        self.set_use_uvloop(use_uvloop)
+        self.loop = None
+        self.nr_accepts = 0
+        self.nr_requests = 0 # 本进程交给handler的请求数，达到max_requests后平滑退出
+        self.sessions = set()
+        self.__connecting = set() # 已accept但尚未调用connection_made的链接
+        self.__drain_deadline = None
+        self.__paused = set() # Executor队列饱和时暂停读取的链接
+        self.__resume_pending = False
+
+    def set_use_uvloop(self, use_uvloop):
+        '''
+        安装了uvloop时是否使用uvloop的事件循环
+        '''
+        self.use_uvloop = use_uvloop
+
+    def create_event_loop(self):
+        if self.use_uvloop and uvloop:
+            logging.info('使用uvloop事件循环')
+            return uvloop.new_event_loop()
+        return asyncio.new_event_loop()
+
+    def serve(self):
+        '''
+        IO处理进程的主循环，以asyncio事件循环代替Poller
+        '''
+        self.loop = self.create_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor.add_drain_listener(self.__request_resume)
+        self.executor.start()
+        self.loop.add_signal_handler(signal.SIGUSR1, self.__dump_stats)
+        self.loop.add_signal_handler(signal.SIGTERM, self.graceful_exit, '收到退出信号')
+        self.loop.add_reader(self.server_socket.fileno(), self.__accept)
+        if self.stats:
+            self.__publish_stats()
+        try:
+            self.loop.run_forever()
+        finally:
+            for session in self.sessions:
+                session.transport.abort()
+            self.loop.close()
+
+    def __publish_stats(self):
+        self.publish_stats(self.nr_accepts, self.nr_requests, len(self.sessions), len(self.__paused))
+        self.loop.call_later(nioserver.STATS_INTERVAL, self.__publish_stats)
+
+    def __dump_stats(self):
+        self.dump_stats(self.nr_accepts, self.nr_requests, len(self.sessions), len(self.__paused))
+
+    def __accept(self):
+        # 一次事件最多accept accept_batch个链接，与Poller一致
+        for i in range(self.accept_batch):
+            try:
+                connection, client_address = self.server_socket.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logging.error(e)
+                return
+            connection.setblocking(False)
+            task = self.loop.create_task(self.loop.connect_accepted_socket(lambda: AIOSession(self), connection))
+            self.__connecting.add(task)
+            task.add_done_callback(self.__connecting.discard)
+
+    def graceful_exit(self, reason):
+        '''
+        停止accept，Executor中的请求都处理完、响应都发送完或graceful_timeout到期后结束事件循环
+        '''
+        if self.__drain_deadline is not None:
+            return
+        logging.info('IO处理进程[%s, pid=%d]%s，停止accept并开始平滑退出' % (str(self.worker_id), os.getpid(), reason))
+        self.__drain_deadline = time.monotonic() + self.graceful_timeout
+        self.loop.remove_reader(self.server_socket.fileno())
+        # 共享服务端socket时只关闭本进程的描述符，其它IO处理进程继续accept
+        self.server_socket.close()
+        self.__check_drained()
+
+    def __check_drained(self):
+        if time.monotonic() >= self.__drain_deadline:
+            logging.warning('IO处理进程[%s, pid=%d]平滑退出超时' % (str(self.worker_id), os.getpid()))
+        elif self.__connecting or not self.executor.is_idle() or any(session.transport.get_write_buffer_size() or session.is_sending() for session in self.sessions) \
+                or not all(self.__is_idle(session) for session in self.sessions):
+            self.loop.call_later(nioserver.DRAIN_CHECK_INTERVAL, self.__check_drained)
+            return
+        self.loop.stop()
+
+    def __is_idle(self, session):
+        is_idle = getattr(self.handler, 'is_idle', None)
+        return not is_idle or is_idle(session)
+
+    def request_received(self):
+        self.nr_requests += 1
+        if self.max_requests is not None and self.nr_requests >= self.max_requests:
+            self.graceful_exit('已处理%d个请求' % self.nr_requests)
+
+    def pause_reading(self, session):
+        if nioserver.LOG_DEBUG:
+            logging.debug('Executor队列饱和，暂停读取客户端[%s:%d]' % session.client_address)
+        if nioserver.TRACER:
+            nioserver.TRACER.record(trace.TRACE_PAUSE, session.fileno())
+        self.__paused.add(session)
+        session.transport.pause_reading()
+
+    def discard_paused(self, session):
+        self.__paused.discard(session)
+
+    def __request_resume(self):
+        '''
+        Executor队列降到低水位时由Executor线程调用
+        '''
+        if self.__resume_pending:
+            return
+        self.__resume_pending = True
+        self.loop.call_soon_threadsafe(self.__resume_reading)
+
+    def __resume_reading(self):
+        self.__resume_pending = False
+        if self.executor.is_saturated():
+            return
+        if nioserver.LOG_DEBUG:
+            logging.debug('Executor队列恢复，继续读取[%d]个客户端' % len(self.__paused))
+        if nioserver.TRACER:
+            nioserver.TRACER.record(trace.TRACE_RESUME, -1, len(self.__paused))
+        paused = self.__paused
+        self.__paused = set()
+        for session in paused:
+            session.resume_reading()
+
+
+class AIOSession(asyncio.Protocol):
+    '''
+    每个链接一个实例，对handler提供与nioserver.Session相同的接口
+    handler在Executor线程中调用write、close等方法，统一经call_soon_threadsafe交给事件循环线程执行，执行顺序与调用顺序一致
+    '''
+    def __init__(self, server):
+        self.__server = server
+        self.__loop = server.loop
+        self.transport = None
+        self.client_address = None
+        self.__fd = -1
+        self.__reading = False # handler调用recv_ready之后才读取数据
+        self.__shut_rd = False
+        self.__shut_wr = False
+        self.__closed = False
+        self.__finished = False # 链接已断开或已超时，不再触发handler事件
+        self.__timeout = None
+        self.__deadline = None
+        self.__timer = None
+        self.last_active = time.monotonic()
+        self.attributes = {}
+        self.__writable = threading.Condition() # 可以继续写或链接已断开时通知
+        self.__queued = 0 # 已由Executor线程写入、事件循环还未交给transport的字节数
+        self.__write_paused = False # transport缓冲超过高水位
+        self.__sending = None # 正在执行的loop.sendfile()
+        self.__backlog = collections.deque() # sendfile期间提交的写入和关闭，sendfile完成后按顺序执行
+
+    def fileno(self):
+        return self.__fd
+
+    def set_timeout(self, timeout, absolute=False):
+        '''
+        设置超时秒数，None表示不超时，超时后关闭链接并触发handler.timeout
+        默认从最后一次收发数据开始计时，有活动即顺延；absolute为True时从现在开始计时，活动不再顺延
+        '''
+        now = time.monotonic()
+        self.last_active = now
+        self.__deadline = now + timeout if absolute and timeout is not None else None
+        self.__timeout = timeout
+        self.__loop.call_soon_threadsafe(self.__schedule_timeout)
+
+    def get_deadline(self):
+        '''
+        超时时刻(time.monotonic())，不超时返回None
+        '''
+        timeout = self.__timeout
+        if timeout is None:
+            return None
+        return self.__deadline if self.__deadline is not None else self.last_active + timeout
+
+    def recv_ready(self):
+        '''
+        准备接收数据
+        '''
+        if self.__shut_rd or self.__closed:
+            raise Exception('客户端[%s:%d]输入已经关闭' % self.client_address)
+        self.last_active = time.monotonic()
+        self.__reading = True
+        self.__loop.call_soon_threadsafe(self.resume_reading)
+
+    def write(self, bytes):
+        if self.__shut_wr or self.__closed:
+            raise Exception('客户端[%s:%d]输出已经关闭' % self.client_address)
+        if nioserver.LOG_DEBUG:
+            logging.debug('向客户端[%s:%d]写数据' % self.client_address)
+        if nioserver.TRACER:
+            nioserver.TRACER.record(trace.TRACE_WRITE, self.__fd, len(bytes))
+        self.last_active = time.monotonic()
+        if not isinstance(bytes, nioserver.FileRegion):
+            with self.__writable:
+                self.__queued += len(bytes)
+        self.__loop.call_soon_threadsafe(self.__run, self.__write, bytes)
+
+    def wait_writable(self, timeout=None):
+        '''
+        由Executor线程在流式输出时调用，未发送的字节超过nioserver.WRITE_HIGH_WATERMARK时阻塞，直到降到低水位以下
+        超时或链接已断开时返回False
+        '''
+        writable = lambda: not self.__write_paused and self.__queued <= nioserver.WRITE_HIGH_WATERMARK
+        with self.__writable:
+            if not writable():
+                self.__writable.wait_for(lambda: self.__finished or not self.__write_paused and self.__queued <= nioserver.WRITE_LOW_WATERMARK, timeout)
+            return not self.__finished and writable()
+
+    def shutdown(self, how):
+        if self.__closed:
+            raise Exception('客户端[%s:%d]已经关闭' % self.client_address)
+        if how is socket.SHUT_RD:
+            if self.__shut_rd:
+                raise Exception('客户端[%s:%d]输入已经关闭' % self.client_address)
+            if nioserver.LOG_DEBUG:
+                logging.debug('关闭客户端[%s:%d]输入' % self.client_address)
+            self.__shut_rd = True
+            self.__loop.call_soon_threadsafe(self.__pause)
+        elif how is socket.SHUT_WR:
+            if self.__shut_wr:
+                raise Exception('客户端[%s:%d]输出已经关闭' % self.client_address)
+            if nioserver.LOG_DEBUG:
+                logging.debug('关闭客户端[%s:%d]输出' % self.client_address)
+            self.__shut_wr = True
+            self.__loop.call_soon_threadsafe(self.__run, self.__write_eof)
+        elif how is socket.SHUT_RDWR:
+            if self.__shut_rd or self.__shut_wr:
+                raise Exception('客户端[%s:%d]输入和输出已经关闭' % self.client_address)
+            if nioserver.LOG_DEBUG:
+                logging.debug('关闭客户端[%s:%d]输入输出' % self.client_address)
+            self.__shut_rd = True
+            self.__shut_wr = True
+            self.__loop.call_soon_threadsafe(self.__pause)
+            self.__loop.call_soon_threadsafe(self.__run, self.__write_eof)
+
+    def close(self):
+        if self.__closed:
+            raise Exception('客户端[%s:%d]已经关闭' % self.client_address)
+        if nioserver.LOG_DEBUG:
+            logging.debug('关闭客户端[%s:%d]' % self.client_address)
+        self.__closed = True
+        # transport.close()会先发送完缓冲中的数据
+        self.__loop.call_soon_threadsafe(self.__run, self.transport.close)
+
+    # 以下方法只在事件循环线程中执行
+
+    def resume_reading(self):
+        if self.__reading and not self.__shut_rd and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def is_sending(self):
+        return self.__sending is not None
+
+    def __run(self, op, *args):
+        '''
+        sendfile期间transport不能写入，之后的写入和关闭暂存，保持与调用顺序一致
+        '''
+        if self.__sending is not None:
+            self.__backlog.append((op, args))
+        else:
+            op(*args)
+
+    def __write(self, bytes):
+        if isinstance(bytes, nioserver.FileRegion):
+            self.__sending = self.__loop.create_task(self.__sendfile(bytes))
+            return
+        self.transport.write(bytes) # 超过高水位时transport在这里调用pause_writing
+        with self.__writable:
+            self.__queued -= len(bytes)
+            if not self.__write_paused and self.__queued <= nioserver.WRITE_LOW_WATERMARK:
+                self.__writable.notify_all()
+
+    async def __sendfile(self, region):
+        '''
+        selector事件循环以os.sendfile()发送，uvloop等不支持的事件循环读出文件内容经transport发送
+        '''
+        try:
+            with open(region.fd, 'rb', closefd=False) as file:
+                await self.__loop.sendfile(self.transport, file, region.offset, region.count)
+        except ConnectionError:
+            self.transport.abort() # 对端已断开，由connection_lost触发handler事件
+        except Exception as e:
+            if not self.transport.is_closing():
+                logging.warning('向客户端[%s:%d]发送文件出错: %s' % (self.client_address[0], self.client_address[1], e))
+                self.transport.abort()
+        finally:
+            region.close()
+            self.__sending = None
+        while self.__backlog and self.__sending is None:
+            op, args = self.__backlog.popleft()
+            op(*args)
+
+    def pause_writing(self):
+        with self.__writable:
+            self.__write_paused = True
+
+    def resume_writing(self):
+        with self.__writable:
+            self.__write_paused = False
+            self.__writable.notify_all()
+
+    def __pause(self):
+        if not self.transport.is_closing():
+            self.transport.pause_reading()
+
+    def __write_eof(self):
+        if not self.transport.is_closing() and self.transport.can_write_eof():
+            self.transport.write_eof()
+
+    def __schedule_timeout(self):
+        if self.__timer:
+            self.__timer.cancel()
+            self.__timer = None
+        deadline = self.get_deadline()
+        if deadline is None or self.__finished:
+            return
+        self.__timer = self.__loop.call_later(max(deadline - time.monotonic(), 0), self.__check_timeout)
+
+    def __check_timeout(self):
+        '''
+        有活动只更新last_active，不重新设置定时器，到期时再检查是否顺延
+        '''
+        self.__timer = None
+        deadline = self.get_deadline()
+        if deadline is None or self.__finished:
+            return
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            self.__timer = self.__loop.call_later(delay, self.__check_timeout)
+            return
+        if nioserver.LOG_INFO:
+            logging.info('客户端[%s:%d]超时' % self.client_address)
+        if nioserver.TRACER:
+            nioserver.TRACER.record(trace.TRACE_TIMEOUT, self.__fd)
+        self.__finish()
+        self.transport.abort()
+        self.__server.executor.execute(self.__server.handler.timeout, self) # 触发超时事件
+
+    def __finish(self):
+        with self.__writable:
+            self.__finished = True
+            self.__writable.notify_all()
+        self.__server.discard_paused(self)
+        self.__server.sessions.discard(self)
+        if self.__timer:
+            self.__timer.cancel()
+            self.__timer = None
+
+    def connection_made(self, transport):
+        self.__server.nr_accepts += 1
+        self.__server.sessions.add(self)
+        self.transport = transport
+        self.client_address = transport.get_extra_info('peername')[:2]
+        self.__fd = transport.get_extra_info('socket').fileno()
+        if nioserver.TRACER:
+            nioserver.TRACER.record(trace.TRACE_ACCEPT, self.__fd, self.__server.nr_accepts)
+        if nioserver.LOG_DEBUG:
+            logging.debug('[%s:%d]链接本服务器' % self.client_address)
+        transport.pause_reading() # 与Poller一致，handler.connect调用recv_ready之后才读取
+        transport.set_write_buffer_limits(nioserver.WRITE_HIGH_WATERMARK, nioserver.WRITE_LOW_WATERMARK)
+        self.set_timeout(self.__server.idle_timeout)
+        self.__server.executor.execute(self.__server.handler.connect, self) # 触发链接事件
+
+    def data_received(self, data):
+        if nioserver.LOG_DEBUG:
+            logging.debug('读取客户端[%s:%d]发送的数据' % self.client_address)
+        self.last_active = time.monotonic()
+        server = self.__server
+        executor = server.executor
+        requests = server.decode(self, data)
+        if nioserver.TRACER:
+            nioserver.TRACER.record(trace.TRACE_RECV, self.__fd, len(data))
+            if requests:
+                nioserver.TRACER.record(trace.TRACE_DECODE, self.__fd, len(requests))
+        if requests:
+            for request in requests:
+                if nioserver.LOG_INFO:
+                    logging.info('接收到客户端[%s:%d]的完整请求' % self.client_address)
+                if server.shed_load and executor.is_saturated():
+                    server.handler.reject(self, request) # 直接拒绝，不进入Executor队列
+                    continue
+                if nioserver.TRACER:
+                    nioserver.TRACER.record(trace.TRACE_EXECUTE, self.__fd, executor.jobs.qsize())
+                executor.execute(server.handler.recv, self, request) # 触发数据到达事件
+                server.request_received()
+        if not server.shed_load and executor.is_saturated() and not self.transport.is_closing():
+            # Executor处理不过来，暂停读取，请求留在内核缓冲中，由TCP流控反压到客户端
+            server.pause_reading(self)
+
+    def eof_received(self):
+        if nioserver.LOG_INFO:
+            logging.info('客户端[%s:%d]输出终止' % self.client_address)
+        self.__server.executor.execute(self.__server.handler.close, self) # 触发客户端关闭事件
+        return True # 保持半关闭，由handler决定何时关闭链接
+
+    def connection_lost(self, exc):
+        if nioserver.TRACER:
+            nioserver.TRACER.record(trace.TRACE_CLOSE, self.__fd)
+        if self.__finished:
+            return
+        self.__finish()
+        if self.__closed:
+            return
+        if exc is None or isinstance(exc, (ConnectionResetError, BrokenPipeError)):
+            logging.warning('客户端[%s:%d]强行关闭' % self.client_address)
+            self.__server.executor.execute(self.__server.handler.hup, self) # 触发强行关闭事件
+        else:
+            logging.warning('客户端[%s:%d]发生错误: %s' % (self.client_address[0], self.client_address[1], exc))
+            self.__server.executor.execute(self.__server.handler.error, self) # 触发错误事件
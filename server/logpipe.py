@@ -0,0 +1,171 @@
+'''
+异步日志
+Executor线程、Poller线程只把日志记录放入有界队列，由每个进程一个的写日志线程批量写文件，业务线程不再争用文件处理器的锁
+队列满时按丢弃策略处理：低于keep_level的新记录直接丢弃；keep_level及以上的记录挤掉队列中最早的一条，写日志线程定期报告丢弃数量
+Fork之后子进程重新创建队列和写日志线程(os.register_at_fork)，每个IO处理进程各自追加写同一个日志文件
+'''
+import logging
+import logging.handlers
+import os
+import queue
+
+__all__ = ['install']
+
+DEFAULT_FORMAT = '%(process)d %(threadName)s %(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s'
+DEFAULT_DATEFMT = '%Y-%m-%d %H:%M:%S'
+DEFAULT_MAX_QUEUE = 10000 # 队列中最多缓存的日志记录数
+DEFAULT_BATCH_SIZE = 64 * 1024 # 批量写入的字节数，队列已空时不足该字节数也立即写入
+DEFAULT_KEEP_LEVEL = logging.WARNING # 不低于该级别的日志在队列满时挤掉最早的记录，而不是被丢弃
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    '''
+    非阻塞放入有界队列，队列满时按丢弃策略处理
+    '''
+    def __init__(self, queue, keep_level=DEFAULT_KEEP_LEVEL):
+        super().__init__(queue)
+        self.keep_level = keep_level
+        self.listener = None
+        self.nr_dropped = 0 # 只做累加，不需要加锁，偶尔少计一次无关紧要
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        if record.levelno < self.keep_level:
+            self.nr_dropped += 1
+            return
+        try:
+            self.queue.get_nowait()
+            self.nr_dropped += 1
+        except queue.Empty:
+            pass
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.nr_dropped += 1
+
+    def close(self):
+        # logging.shutdown()时先写完队列中的日志，IO处理进程退出前会调用
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+        super().close()
+
+class BatchFileHandler(logging.FileHandler):
+    '''
+    只由写日志线程调用，日志先放入缓冲，达到batch_size或队列已空时一次写入
+    '''
+    def __init__(self, filename, mode='a', encoding=None, batch_size=DEFAULT_BATCH_SIZE):
+        super().__init__(filename, mode, encoding)
+        self.batch_size = batch_size
+        self.__buffer = []
+        self.__buffered = 0
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + self.terminator
+        except Exception:
+            self.handleError(record)
+            return
+        self.__buffer.append(msg)
+        self.__buffered += len(msg)
+        if self.__buffered >= self.batch_size:
+            self.flush()
+
+    def discard(self):
+        '''
+        丢弃缓冲中的日志，Fork之后子进程继承了父进程的缓冲，这些日志由父进程负责写入
+        '''
+        self.__buffer = []
+        self.__buffered = 0
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.__buffer and self.stream:
+                self.stream.write(''.join(self.__buffer))
+                self.stream.flush()
+            self.__buffer = []
+            self.__buffered = 0
+        finally:
+            self.release()
+
+class BatchQueueListener(logging.handlers.QueueListener):
+    '''
+    队列取空时才刷新文件，连续到达的日志合并为一次write
+    '''
+    def __init__(self, queue, handler, queue_handler):
+        super().__init__(queue, handler)
+        self.queue_handler = queue_handler
+        self.__nr_reported = 0
+
+    def dequeue(self, block):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            if not block:
+                raise
+        self.__report_dropped()
+        for handler in self.handlers:
+            handler.flush()
+        return self.queue.get()
+
+    def __report_dropped(self):
+        nr_dropped = self.queue_handler.nr_dropped
+        if nr_dropped > self.__nr_reported:
+            record = logging.makeLogRecord({'name': 'logpipe', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': '日志队列已满，丢弃了%d条日志' % (nr_dropped - self.__nr_reported)})
+            self.__nr_reported = nr_dropped
+            self.handle(record)
+
+    def stop(self):
+        super().stop()
+        self.__report_dropped()
+        for handler in self.handlers:
+            handler.flush()
+
+_installed = None # install()的参数，Fork之后在子进程中重新安装
+
+def install(filename, level=logging.INFO, format=DEFAULT_FORMAT, datefmt=DEFAULT_DATEFMT, mode='a', encoding='UTF-8',
+            max_queue=DEFAULT_MAX_QUEUE, batch_size=DEFAULT_BATCH_SIZE, keep_level=DEFAULT_KEEP_LEVEL):
+    '''
+    替换根日志的处理器，mode只对当前进程有效，Fork出的子进程总是追加写
+    '''
+    global _installed
+    first = _installed is None
+    _installed = dict(filename=filename, level=level, format=format, datefmt=datefmt, encoding=encoding,
+            max_queue=max_queue, batch_size=batch_size, keep_level=keep_level)
+    _setup(mode=mode, **_installed)
+    if first:
+        os.register_at_fork(after_in_child=_reinstall)
+
+def _setup(filename, level, format, datefmt, mode, encoding, max_queue, batch_size, keep_level):
+    file_handler = BatchFileHandler(filename, mode, encoding, batch_size)
+    file_handler.setFormatter(logging.Formatter(format, datefmt))
+    queue_handler = BoundedQueueHandler(queue.Queue(max_queue), keep_level)
+    listener = BatchQueueListener(queue_handler.queue, file_handler, queue_handler)
+    queue_handler.listener = listener
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        if isinstance(handler, BoundedQueueHandler):
+            handler.close()
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener.start()
+
+def _reinstall():
+    '''
+    Fork之后只有调用fork的线程存活，父进程的写日志线程和队列不能再用
+    父进程的处理器直接丢弃而不关闭
+    '''
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, BoundedQueueHandler):
+            root.removeHandler(handler)
+            if handler.listener:
+                [h.discard() for h in handler.listener.handlers]
+            handler.listener = None
+    _setup(mode='a', **_installed)
@@ -1,22 +1,39 @@
 import logging
 import multiprocessing, threading
 import collections, queue
+import itertools
 import os, sys
+import time
 import traceback
 import select, socket
+import signal
+import server.stats as stats
+import server.trace as trace
 
-__all__ = ['Executor', 'PooledExecutor', 'NIOServer']
+__all__ = ['Executor', 'PooledExecutor', 'NIOServer', 'PollBackend', 'EpollBackend', 'FileRegion']
            
 class Executor:
     
-    def __init__(self, jobs):
-        self.jobs = jobs
+    def __init__(self, pool):
+        self.pool = pool
+        self.jobs = pool.jobs
     
     def start(self):
+        idle_timeout = self.pool.idle_timeout if self.pool.min_threads < self.pool.nr_threads else None
         while True:
             try:
-                callable, args, kwargs = self.jobs.get()
-                callable(*args, **kwargs)
+                try:
+                    callable, args, kwargs, enqueue_time = self.jobs.get(timeout=idle_timeout)
+                except queue.Empty:
+                    # 空闲超时，线程数超过min_threads时退出
+                    if self.pool.retire():
+                        return
+                    continue
+                self.pool.job_started(enqueue_time)
+                try:
+                    callable(*args, **kwargs)
+                finally:
+                    self.pool.job_finished()
             except Exception as e:
                 logging.error(e)
                 traceback.print_exc()
@@ -24,50 +41,282 @@ class Executor:
 class PooledExecutor:
 
     DEFAULT_NR_THREADS = 4
+    DEFAULT_GROW_WAIT = 0.05 # 任务排队超过该秒数且没有空闲线程时增加线程
+    DEFAULT_IDLE_TIMEOUT = 60 # 线程空闲超过该秒数且线程数超过min_threads时退出
     
-    def __init__(self, name='Handler-exec', nr_threads=DEFAULT_NR_THREADS):
+    def __init__(self, name='Handler-exec', nr_threads=DEFAULT_NR_THREADS, max_queue=None, min_threads=None, grow_wait=DEFAULT_GROW_WAIT, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        '''
+        nr_threads为最大线程数，min_threads为常驻线程数，默认与nr_threads相同即固定大小
+        '''
         if nr_threads < 1:
             raise ValueError('参数[nr_threads]不能小于1')
         self.name = name
         self.nr_threads = nr_threads
+        self.set_min_threads(min_threads)
+        self.grow_wait = grow_wait
+        self.idle_timeout = idle_timeout
         self.jobs = queue.Queue()
+        self.set_max_queue(max_queue)
+        self.__threads_lock = threading.Lock()
+        self.__nr_alive = 0 # 存活线程数
+        self.__nr_idle = 0 # 空闲线程数
+        self.__nr_unfinished = 0 # 已提交但尚未执行完的任务数
+        self.__thread_seq = 0
+        self.__saturated = False
+        self.__drain_listeners = []
+        self.__stats_lock = threading.Lock()
+        # 统计，由Executor线程更新
+        self.nr_jobs = 0 # 已开始执行的任务数
+        self.total_wait = 0.0 # 任务排队等待的总秒数
+        self.max_wait = 0.0 # 任务排队等待的最长秒数
+        self.avg_wait = 0.0 # 任务排队等待秒数的指数移动平均
+        self.max_depth = 0 # 观察到的最大队列深度
+        self.wait_histogram = [0] * stats.WAIT_BUCKETS # 排队等待时间直方图，桶的划分见server.stats
     
     def set_nr_threads(self, nr_threads):
         if nr_threads is None or nr_threads < 1:
             raise ValueError('参数[nr_threads]不能小于1')
         self.nr_threads = nr_threads
+    
+    def set_min_threads(self, min_threads):
+        '''
+        min_threads为None表示固定为nr_threads个线程
+        '''
+        if min_threads is not None and min_threads < 1:
+            raise ValueError('参数[min_threads]不能小于1')
+        self.__min_threads = min_threads
+    
+    @property
+    def min_threads(self):
+        return self.nr_threads if self.__min_threads is None else min(self.__min_threads, self.nr_threads)
+    
+    def set_max_queue(self, max_queue):
+        '''
+        有界队列模式，队列深度达到max_queue后is_saturated()返回True，由调用方决定停止读取或拒绝请求
+        队列本身不设上限，链接、关闭等事件仍然可以提交，避免阻塞Poller线程
+        队列深度降到max_queue的一半时通知add_drain_listener()注册的回调
+        '''
+        if max_queue is not None and max_queue < 1:
+            raise ValueError('参数[max_queue]不能小于1')
+        self.max_queue = max_queue
+        self.low_watermark = max_queue // 2 if max_queue is not None else None
+    
+    def add_drain_listener(self, listener):
+        self.__drain_listeners.append(listener)
+    
+    def is_saturated(self):
+        if self.max_queue is None:
+            return False
+        if self.jobs.qsize() >= self.max_queue:
+            self.__saturated = True
+        return self.__saturated
             
     def start(self):
-        [threading.Thread(name='%s-%d' % (self.name, i), target=Executor(self.jobs).start).start() for i in range(self.nr_threads)]
+        [self.__grow(force=True) for i in range(self.min_threads)]
+    
+    def __grow(self, force=False):
+        '''
+        增加一个线程，force为False时只在没有空闲线程且未达到最大线程数时增加
+        '''
+        with self.__threads_lock:
+            if not force and (self.__nr_idle or self.__nr_alive >= self.nr_threads):
+                return
+            self.__nr_alive += 1
+            self.__nr_idle += 1
+            self.__thread_seq += 1
+            name = '%s-%d' % (self.name, self.__thread_seq)
+        logging.debug('Executor增加线程[%s]' % name)
+        threading.Thread(name=name, target=Executor(self).start).start()
+    
+    def retire(self):
+        '''
+        空闲线程超时后调用，返回True表示该线程应当退出
+        '''
+        with self.__threads_lock:
+            if self.__nr_alive <= self.min_threads:
+                return False
+            self.__nr_alive -= 1
+            self.__nr_idle -= 1
+        logging.debug('Executor线程[%s]空闲退出' % threading.current_thread().name)
+        return True
     
     def execute(self, callable, *args, **kwargs):
         if callable is None:
             raise ValueError('参数[callable]不能为空')
-        self.jobs.put((callable, args, kwargs))
+        now = time.monotonic()
+        with self.__threads_lock:
+            self.__nr_unfinished += 1
+        self.jobs.put((callable, args, kwargs, now))
+        if not self.__nr_idle and self.__nr_alive < self.nr_threads:
+            # 所有线程都在处理耗时任务时不会有任务开始执行，需要在提交时检查队头任务的等待时间
+            with self.jobs.mutex:
+                oldest = self.jobs.queue[0][3] if self.jobs.queue else now
+            if now - oldest >= self.grow_wait:
+                self.__grow()
+    
+    def job_finished(self):
+        with self.__threads_lock:
+            self.__nr_idle += 1
+            self.__nr_unfinished -= 1
+    
+    def is_idle(self):
+        '''
+        所有已提交的任务都已执行完，用于IO处理进程平滑退出
+        '''
+        return not self.__nr_unfinished
+    
+    def job_started(self, enqueue_time):
+        '''
+        由Executor线程在任务开始执行前调用，记录排队时间，队列降到低水位时通知
+        '''
+        wait = time.monotonic() - enqueue_time
+        depth = self.jobs.qsize()
+        drained = False
+        with self.__threads_lock:
+            self.__nr_idle -= 1
+        if wait >= self.grow_wait and depth:
+            self.__grow()
+        with self.__stats_lock:
+            self.nr_jobs += 1
+            self.total_wait += wait
+            self.avg_wait += (wait - self.avg_wait) / 16
+            if wait > self.max_wait:
+                self.max_wait = wait
+            if depth >= self.max_depth:
+                self.max_depth = depth + 1
+            self.wait_histogram[min(int(wait * 1000).bit_length(), stats.WAIT_BUCKETS - 1)] += 1
+            if self.__saturated and depth <= self.low_watermark:
+                self.__saturated = False
+                drained = True
+        if drained:
+            [listener() for listener in self.__drain_listeners]
+    
+    def get_stats(self):
+        return {'threads': self.__nr_alive, 'idle_threads': self.__nr_idle, 'depth': self.jobs.qsize(), 'max_depth': self.max_depth, 'jobs': self.nr_jobs, 
+                'avg_wait': self.avg_wait, 'max_wait': self.max_wait, 'total_wait': self.total_wait, 'saturated': self.__saturated}
+
+NUMA_NODE_PATH = '/sys/devices/system/node' # Linux下NUMA节点信息
+CPU_AFFINITY_MODES = ('core', 'node') # 内置的IO处理进程CPU绑定方式
+
+def parse_cpu_list(cpu_list):
+    '''
+    解释内核的CPU列表格式，例如 0-3,8-11
+    '''
+    cpus = set()
+    for part in cpu_list.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+def format_cpu_list(cpus):
+    '''
+    与parse_cpu_list相反，连续的CPU编号合并为区间
+    '''
+    parts = []
+    for cpu in sorted(cpus):
+        if parts and parts[-1][1] == cpu - 1:
+            parts[-1][1] = cpu
+        else:
+            parts.append([cpu, cpu])
+    return ','.join('%d-%d' % (first, last) if first != last else str(first) for first, last in parts)
+
+def numa_nodes(cpus):
+    '''
+    按NUMA节点划分cpus，只保留非空的节点，没有NUMA信息时整体作为一个节点
+    '''
+    nodes = []
+    try:
+        names = sorted((name for name in os.listdir(NUMA_NODE_PATH) if name.startswith('node') and name[4:].isdigit()), key=lambda name: int(name[4:]))
+        for name in names:
+            with open(os.path.join(NUMA_NODE_PATH, name, 'cpulist')) as f:
+                node = parse_cpu_list(f.read()) & cpus
+            if node:
+                nodes.append(node)
+    except OSError:
+        pass
+    return nodes or [set(cpus)]
+
+LISTEN_FD_ENV = 'NIOSERVER_LISTEN_FD' # 重启时传给新主进程的服务端socket描述符
+RETIRING_ENV = 'NIOSERVER_RETIRING' # 重启时传给新主进程的旧IO处理进程pid，逗号分隔
 
 class NIOServer:
     
     DEFAULT_ADDRESS = ('', 8000) # 默认监听地址
     DEFAULT_NR_PROCESSORS = multiprocessing.cpu_count() # IO处理进程数，默认为CPU的核数
-    DEFAULT_LISTEN_BACKLOG = 5 # 默认服务端socket允许同时连接请求数
-    DEFAULT_DECODE = lambda session, bytes: (bytes,) # 默认协议decode
+    DEFAULT_LISTEN_BACKLOG = socket.SOMAXCONN # 默认服务端socket允许同时连接请求数，实际上限由内核参数net.core.somaxconn决定
+    DEFAULT_ACCEPT_BATCH = 64 # 每次服务端描述符事件最多accept的链接数
+    DEFAULT_DECODE = lambda session, data: (bytes(data),) # 默认协议decode，data为接收缓冲的memoryview，保留时必须复制
+    DEFAULT_IDLE_TIMEOUT = 300 # 默认链接空闲超时秒数，协议处理可通过Session.set_timeout()调整
+    DEFAULT_RECV_BUFFER_SIZE = 16 * 1024 # 接收缓冲初始及最小字节数
+    DEFAULT_MAX_RECV_BUFFER_SIZE = 256 * 1024 # 接收缓冲最大字节数
     DEFAULT_EXECUTOR= PooledExecutor() # Handler Executor
+    DEFAULT_POLLER = 'epoll' if hasattr(select, 'epoll') else 'poll' # 默认轮询后端，Linux下优先使用epoll
+    DEFAULT_GRACEFUL_TIMEOUT = 30 # IO处理进程平滑退出时等待未完成请求的最长秒数
     
-    def __init__(self, address=DEFAULT_ADDRESS, nr_processors=DEFAULT_NR_PROCESSORS, listen_backlog=DEFAULT_LISTEN_BACKLOG, sockopts=(), decode=DEFAULT_DECODE, executor=DEFAULT_EXECUTOR, exec_nr_threads=None, handler=None):
+    def __init__(self, address=DEFAULT_ADDRESS, nr_processors=DEFAULT_NR_PROCESSORS, listen_backlog=DEFAULT_LISTEN_BACKLOG, sockopts=(), decode=DEFAULT_DECODE, executor=DEFAULT_EXECUTOR, exec_nr_threads=None, handler=None, poller=DEFAULT_POLLER, edge_triggered=False, reuse_port=False, accept_batch=DEFAULT_ACCEPT_BATCH, recv_buffer_size=DEFAULT_RECV_BUFFER_SIZE, max_recv_buffer_size=DEFAULT_MAX_RECV_BUFFER_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT, exec_max_queue=None, shed_load=False, exec_min_threads=None, max_requests=None, graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT, cpu_affinity=None, stats_file=None, trace_file=None, trace_capacity=trace.DEFAULT_CAPACITY):
         '''
         设置服务器参数
         '''
+        self.set_poller(poller, edge_triggered)
         self.set_address(address)
         self.set_nr_processors(nr_processors)
         self.set_listen_backlog(listen_backlog)
+        self.set_accept_batch(accept_batch)
+        self.set_recv_buffer_size(recv_buffer_size, max_recv_buffer_size)
+        self.set_idle_timeout(idle_timeout)
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sockopts = []
         self.set_sockopts(sockopts)
+        self.set_reuse_port(reuse_port)
+        self.workers = {} # IO处理进程 pid -> 进程编号，只在主进程中有效
+        self.retiring = set() # 重启后正在平滑退出的旧IO处理进程，退出后不再Fork
+        self.worker_id = None # 当前IO处理进程编号，主进程中为None
+        # 重启时按原来的命令重新执行，daemonize()会切换工作目录，相对路径要在原目录下解析
+        self.argv = [sys.executable] + (sys.orig_argv[1:] if hasattr(sys, 'orig_argv') else sys.argv)
+        self.cwd = os.getcwd()
+        self.set_max_requests(max_requests)
+        self.set_graceful_timeout(graceful_timeout)
+        self.set_cpu_affinity(cpu_affinity)
+        self.cpu_placement = None # IO处理进程编号 -> CPU集合，start()时计算
+        self.set_stats_file(stats_file)
+        self.stats = None # 共享内存统计，start()时创建
+        self.set_trace_file(trace_file, trace_capacity)
         self.set_decode(decode)
         self.set_executor(executor)
         if exec_nr_threads is not None:
             self.set_executor_nr_threads(exec_nr_threads)
+        if exec_min_threads is not None:
+            self.set_executor_min_threads(exec_min_threads)
+        if exec_max_queue is not None:
+            self.set_executor_max_queue(exec_max_queue)
+        self.set_shed_load(shed_load)
         self.set_handler(handler)
     
+    def set_poller(self, poller, edge_triggered=False):
+        '''
+        设置轮询后端，取值为POLL_BACKENDS中的名称，edge_triggered只对epoll有效
+        '''
+        if poller not in POLL_BACKENDS:
+            raise ValueError('参数[poller]只能取值为%s' % str(tuple(POLL_BACKENDS)))
+        if edge_triggered and poller != 'epoll':
+            raise ValueError('只有epoll支持边缘触发模式')
+        logging.debug('设置服务器参数 poller: [%s], edge_triggered: [%s]' % (poller, str(edge_triggered)))
+        self.poller = poller
+        self.edge_triggered = edge_triggered
+
+    def create_poll_backend(self):
+        '''
+        创建轮询后端，每个IO处理进程各自创建
+        '''
+        if self.poller == 'epoll':
+            return EpollBackend(self.edge_triggered)
+        return POLL_BACKENDS[self.poller]()
+
     def set_address(self, address):
         if address is None:
             raise ValueError('参数[address]不能为空')
@@ -86,6 +335,133 @@ class NIOServer:
         logging.debug('设置服务器参数 listen_backlog: [%d]' % listen_backlog)
         self.listen_backlog = listen_backlog
 
+    def set_accept_batch(self, accept_batch):
+        if accept_batch is None or accept_batch < 1:
+            raise ValueError('参数[accept_batch]不能小于1')
+        logging.debug('设置服务器参数 accept_batch: [%d]' % accept_batch)
+        self.accept_batch = accept_batch
+
+    def set_recv_buffer_size(self, recv_buffer_size, max_recv_buffer_size):
+        '''
+        接收缓冲在[recv_buffer_size, max_recv_buffer_size]之间根据实际读取的字节数自适应调整
+        '''
+        if recv_buffer_size is None or recv_buffer_size < 1:
+            raise ValueError('参数[recv_buffer_size]不能小于1')
+        if max_recv_buffer_size is None or max_recv_buffer_size < recv_buffer_size:
+            raise ValueError('参数[max_recv_buffer_size]不能小于recv_buffer_size')
+        logging.debug('设置服务器参数 recv_buffer_size: [%d, %d]' % (recv_buffer_size, max_recv_buffer_size))
+        self.recv_buffer_size = recv_buffer_size
+        self.max_recv_buffer_size = max_recv_buffer_size
+
+    def set_idle_timeout(self, idle_timeout):
+        '''
+        新链接的空闲超时秒数，None表示不超时
+        '''
+        if idle_timeout is not None and idle_timeout <= 0:
+            raise ValueError('参数[idle_timeout]必须大于0')
+        logging.debug('设置服务器参数 idle_timeout: [%s]' % str(idle_timeout))
+        self.idle_timeout = idle_timeout
+
+    def set_max_requests(self, max_requests):
+        '''
+        IO处理进程处理max_requests个请求后平滑退出，由主进程重新Fork，限制内存增长，None表示不限制
+        '''
+        if max_requests is not None and max_requests < 1:
+            raise ValueError('参数[max_requests]不能小于1')
+        logging.debug('设置服务器参数 max_requests: [%s]' % str(max_requests))
+        self.max_requests = max_requests
+
+    def set_graceful_timeout(self, graceful_timeout):
+        if graceful_timeout is None or graceful_timeout < 0:
+            raise ValueError('参数[graceful_timeout]不能小于0')
+        logging.debug('设置服务器参数 graceful_timeout: [%s]' % str(graceful_timeout))
+        self.graceful_timeout = graceful_timeout
+
+    def set_cpu_affinity(self, cpu_affinity):
+        '''
+        IO处理进程(连同其Executor线程)绑定的CPU，减少跨核迁移，提高缓存命中：
+        None - 不绑定，由内核调度
+        'core' - 每个IO处理进程绑定一个CPU，按编号依次分配，进程数多于CPU数时循环使用
+        'node' - 按NUMA节点轮流分配，IO处理进程可在所在节点的所有CPU上运行，内存访问不跨节点
+        CPU编号集合的序列 - 第i个IO处理进程绑定第i个集合，进程数多于集合数时循环使用
+        '''
+        if cpu_affinity is not None:
+            if not hasattr(os, 'sched_setaffinity'):
+                raise ValueError('当前平台不支持sched_setaffinity')
+            if isinstance(cpu_affinity, str):
+                if cpu_affinity not in CPU_AFFINITY_MODES:
+                    raise ValueError('参数[cpu_affinity]只能取值为%s或CPU编号集合的序列' % str(CPU_AFFINITY_MODES))
+            elif not cpu_affinity or not all(cpu_affinity):
+                raise ValueError('参数[cpu_affinity]中的CPU编号集合不能为空')
+        logging.debug('设置服务器参数 cpu_affinity: [%s]' % str(cpu_affinity))
+        self.cpu_affinity = cpu_affinity
+
+    def get_cpu_placement(self):
+        '''
+        按cpu_affinity计算每个IO处理进程编号绑定的CPU集合，不绑定时返回None
+        只在主进程允许使用的CPU(sched_getaffinity)范围内分配
+        '''
+        if self.cpu_affinity is None:
+            return None
+        if self.cpu_affinity == 'core':
+            cpu_sets = [{cpu} for cpu in sorted(os.sched_getaffinity(0))]
+        elif self.cpu_affinity == 'node':
+            cpu_sets = numa_nodes(os.sched_getaffinity(0))
+        else:
+            cpu_sets = [set(cpus) for cpus in self.cpu_affinity]
+        return {i: cpu_sets[i % len(cpu_sets)] for i in range(self.nr_processors)}
+
+    def report_cpu_placement(self):
+        '''
+        输出IO处理进程的CPU绑定情况
+        '''
+        if self.cpu_placement is None:
+            logging.info('IO处理进程不绑定CPU')
+            return
+        for pid, worker_id in sorted(self.workers.items(), key=lambda item: item[1]):
+            logging.info('IO处理进程[%d, pid=%d]绑定CPU[%s]' % (worker_id, pid, format_cpu_list(self.cpu_placement[worker_id])))
+
+    def set_stats_file(self, stats_file):
+        '''
+        共享内存统计文件路径，None表示不统计
+        各IO处理进程每STATS_INTERVAL秒把统计写入自己的槽位，用 python -m server.stats <统计文件> 查看
+        '''
+        logging.debug('设置服务器参数 stats_file: [%s]' % str(stats_file))
+        self.stats_file = stats_file
+
+    def set_trace_file(self, trace_file, trace_capacity=trace.DEFAULT_CAPACITY):
+        '''
+        跟踪文件路径前缀，None表示不跟踪
+        每个IO处理进程映射 <trace_file>.<进程编号> 作为环形缓冲，保留最近trace_capacity个事件，用 python -m server.trace <文件> 查看
+        '''
+        if trace_capacity is None or trace_capacity < 1:
+            raise ValueError('参数[trace_capacity]不能小于1')
+        logging.debug('设置服务器参数 trace_file: [%s], trace_capacity: [%d]' % (str(trace_file), trace_capacity))
+        self.trace_file = trace_file
+        self.trace_capacity = trace_capacity
+
+    def publish_stats(self, accepts, requests, connections, paused):
+        '''
+        由IO处理进程定时调用，写入本进程的统计槽位
+        '''
+        values = self.executor.get_stats()
+        values.update(pid=os.getpid(), worker_id=self.worker_id, updated=time.time(), accepts=accepts, requests=requests, connections=connections, paused=paused)
+        if hasattr(self.handler, 'get_stats'):
+            values.update(self.handler.get_stats()) # 协议相关的统计，例如HttpHandler的链接复用
+        self.stats.publish(self.worker_id, values, self.executor.wait_histogram)
+
+    def dump_stats(self, accepts, requests, connections, paused):
+        '''
+        由IO处理进程收到SIGUSR1后调用，把本进程的统计写入日志
+        '''
+        logging.info('IO处理进程[%s, pid=%d]统计: accepts=%d, requests=%d, connections=%d, paused=%d, cpus=%s' % (str(self.worker_id), os.getpid(), accepts, requests, connections, paused,
+                format_cpu_list(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else '-'))
+        logging.info('IO处理进程[%s, pid=%d]Executor统计: %s' % (str(self.worker_id), os.getpid(),
+                ', '.join('%s=%s' % (name, '%.4f' % value if isinstance(value, float) else value) for name, value in sorted(self.executor.get_stats().items()))))
+        if hasattr(self.handler, 'get_stats'):
+            logging.info('IO处理进程[%s, pid=%d]Handler统计: %s' % (str(self.worker_id), os.getpid(),
+                    ', '.join('%s=%s' % item for item in sorted(self.handler.get_stats().items()))))
+
     def set_sockopt(self, level, name, val):
         '''
         必须在setup()方法之后调用
@@ -97,6 +473,7 @@ class NIOServer:
             self.server_socket.close()
             self.server_socket = None
             raise
+        self.sockopts.append((level, name, val)) # reuse_port模式下IO处理进程创建socket时重新设置
 
     def set_sockopts(self, sockopts):
         '''
@@ -105,7 +482,39 @@ class NIOServer:
         if sockopts:
             [self.set_sockopt(opt[0], opt[1], opt[2]) for opt in sockopts]
 
+    def set_reuse_port(self, reuse_port):
+        '''
+        reuse_port模式下每个IO处理进程各自创建SO_REUSEPORT的服务端socket，由内核均衡分配新链接
+        否则所有IO处理进程共享主进程创建的服务端socket
+        '''
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('当前平台不支持SO_REUSEPORT')
+        logging.debug('设置服务器参数 reuse_port: [%s]' % str(reuse_port))
+        self.reuse_port = reuse_port
+
+    def create_server_socket(self):
+        '''
+        创建并监听服务端socket，非阻塞
+        '''
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            for level, name, val in self.sockopts:
+                server_socket.setsockopt(level, name, val)
+            if self.reuse_port:
+                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            server_socket.bind(self.address)
+            server_socket.listen(self.listen_backlog)
+            server_socket.setblocking(False)
+        except Exception:
+            server_socket.close()
+            raise
+        return server_socket
+
     def set_decode(self, decode):
+        '''
+        decode(session, data)在Poller线程中调用，返回完整请求的序列
+        data为进程共用接收缓冲的memoryview，下次接收时就会被覆盖，需要保留的数据必须复制
+        '''
         if decode is None:
             raise ValueError('参数[decode]不能为空')
         logging.debug('设置服务器协议解码器decode')
@@ -121,9 +530,28 @@ class NIOServer:
         logging.debug('设置服务器默认executor线程数量[%d]' % executor_nr_threads)
         self.executor.set_nr_threads(executor_nr_threads)
 
+    def set_executor_min_threads(self, executor_min_threads):
+        logging.debug('设置服务器默认executor常驻线程数量[%d]' % executor_min_threads)
+        self.executor.set_min_threads(executor_min_threads)
+
+    def set_executor_max_queue(self, executor_max_queue):
+        logging.debug('设置服务器默认executor队列上限[%d]' % executor_max_queue)
+        self.executor.set_max_queue(executor_max_queue)
+
+    def set_shed_load(self, shed_load):
+        '''
+        Executor队列饱和时的处理方式：
+        False - 暂停读取客户端数据(撤销可读事件)，队列降到低水位后恢复，请求在内核缓冲中排队
+        True - 继续读取，但在Poller线程中直接调用handler.reject(session, data)拒绝请求
+        '''
+        logging.debug('设置服务器参数 shed_load: [%s]' % str(shed_load))
+        self.shed_load = shed_load
+
     def set_handler(self, handler):
         '''
-        IO处理回调接口，必须提供
+        IO处理回调接口，必须提供connect、recv、close、hup、error、timeout方法
+        shed_load为True时还必须提供reject方法，该方法在Poller线程中调用，不能阻塞
+        可选的is_idle(session)方法在IO处理进程平滑退出时调用，链接上还有未接收完的请求时返回False，没有该方法时所有链接都视为空闲
         '''
         if handler is None:
             raise ValueError('参数[handler]不能为空')
@@ -134,6 +562,10 @@ class NIOServer:
         '''
         标准的2次Fork变成Daemon进程，无需解释太多
         '''
+        if RETIRING_ENV in os.environ:
+            # SIGHUP重启后重新执行的主进程，必须保持原来的pid，旧IO处理进程仍是它的子进程
+            os.chdir('/')
+            return
         try:
             if os.fork() > 0:
                 sys.exit(0)
@@ -159,24 +591,123 @@ class NIOServer:
         # os.dup2(open('/dev/null', 'a+').fileno(), sys.stdout.fileno())
         # os.dup2(open('/dev/null', 'a+').fileno(), sys.stderr.fileno())
 
+    def fork_worker(self, worker_id):
+        '''
+        Fork一个IO处理进程，在子进程中返回True
+        '''
+        pid = os.fork()
+        if pid == 0:
+            self.worker_id = worker_id
+            self.workers = {}
+            self.retiring = set()
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN) # 由Poller重新设置
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            if self.cpu_placement is not None:
+                # 必须在Executor线程启动之前绑定，新线程继承创建者的CPU亲和性
+                try:
+                    os.sched_setaffinity(0, self.cpu_placement[worker_id])
+                except OSError as e:
+                    logging.error('IO处理进程[%d]绑定CPU[%s]失败: %s' % (worker_id, format_cpu_list(self.cpu_placement[worker_id]), e))
+            return True
+        self.workers[pid] = worker_id
+        return False
+
+    def relay_signal(self, signum, frame):
+        '''
+        主进程把信号转发给所有IO处理进程，例如 kill -USR1 <主进程> 让各IO处理进程输出统计
+        '''
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reload(self, signum, frame):
+        '''
+        SIGHUP信号处理，主进程以原来的命令重新执行，加载新的代码
+        服务端socket和pid保持不变，新的主进程Fork新的IO处理进程后通知旧的IO处理进程平滑退出，期间不会拒绝链接
+        reuse_port模式下旧IO处理进程关闭socket时，其accept队列中尚未accept的链接会被内核重置
+        '''
+        logging.info('主进程[%d]重新启动...' % os.getpid())
+        env = dict(os.environ)
+        if self.server_socket is not None:
+            os.set_inheritable(self.server_socket.fileno(), True)
+            env[LISTEN_FD_ENV] = str(self.server_socket.fileno())
+        env[RETIRING_ENV] = ','.join(str(pid) for pid in itertools.chain(self.workers, self.retiring))
+        try:
+            os.chdir(self.cwd)
+            os.execve(self.argv[0], self.argv, env)
+        except OSError as e:
+            logging.error('主进程重新启动失败: %s' % e)
+
     def start(self):
         logging.debug('服务开始启动...')
-        self.server_socket.bind(self.address)
-        self.server_socket.listen(self.listen_backlog)
+        # __init__中创建的socket只用于校验socket选项
+        self.server_socket.close()
+        listen_fd = os.environ.pop(LISTEN_FD_ENV, None)
+        retiring = os.environ.pop(RETIRING_ENV, '')
+        if self.reuse_port:
+            # reuse_port模式下主进程不监听，否则分给主进程的链接永远不会被accept
+            self.server_socket = None
+        elif listen_fd is not None:
+            # 重启前的主进程留下的服务端socket，backlog中的链接不会丢失
+            self.server_socket = socket.socket(fileno=int(listen_fd))
+            self.server_socket.set_inheritable(False)
+        else:
+            self.server_socket = self.create_server_socket()
+        signal.signal(signal.SIGUSR1, self.relay_signal)
+        signal.signal(signal.SIGHUP, self.reload)
+        self.cpu_placement = self.get_cpu_placement()
+        if self.stats_file is not None:
+            # 必须在Fork之前映射，所有IO处理进程共用同一块内存
+            self.stats = stats.StatsSegment.create(self.stats_file, self.nr_processors)
         for i in range(self.nr_processors):
             try:
-                if os.fork() == 0:
+                if self.fork_worker(i):
                     break
             except Exception as e:
                 logging.error(e)
         else:
             logging.debug('服务启动完成，正在监听[%s:%d]' % self.address)
+            self.report_cpu_placement()
+            # 新的IO处理进程已经开始accept，旧的IO处理进程停止accept，处理完已接收的请求后退出
+            self.retiring = set(int(pid) for pid in retiring.split(',') if pid)
+            for pid in self.retiring:
+                logging.info('通知旧IO处理进程[%d]平滑退出' % pid)
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
             while True:
-                os.wait()
-                logging.warn('检测到IO处理进程退出')
+                pid, status = os.wait()
+                if pid in self.retiring:
+                    self.retiring.discard(pid)
+                    logging.info('旧IO处理进程[%d]已退出' % pid)
+                    continue
+                if pid not in self.workers:
+                    # 不是本主进程Fork的IO处理进程，例如应用启动的其它子进程，不能替它重新Fork
+                    logging.info('未知子进程[%d]已退出' % pid)
+                    continue
+                worker_id = self.workers.pop(pid)
+                logging.warn('检测到IO处理进程[%d]退出' % pid)
                 # 检测到有IO处理子进程退出，立即Fork一个子IO处理进程
-                if os.fork() == 0:
+                if self.fork_worker(worker_id):
                     break
+        if self.reuse_port:
+            self.server_socket = self.create_server_socket()
+        update_log_guards()
+        if self.trace_file is not None:
+            set_tracer(trace.Tracer('%s.%d' % (self.trace_file, self.worker_id), self.trace_capacity))
+        self.serve()
+        # 平滑退出，Executor线程不是daemon线程，必须直接结束进程，由主进程重新Fork
+        logging.info('IO处理进程[%s, pid=%d]退出' % (str(self.worker_id), os.getpid()))
+        logging.shutdown()
+        os._exit(0)
+
+    def serve(self):
+        '''
+        IO处理进程的主循环，子类可替换为其它事件循环
+        '''
         self.executor.start()
         Poller(self).start()
 
@@ -191,8 +722,207 @@ EVENT_SHUT_RD = 4 # 关闭输入端
 EVENT_SHUT_WR = 5 # 关闭输出端
 EVENT_SHUT_RDWR = 6 # 关闭输入和输出端
 EVENT_CLOSE = 7 # 关闭描述符
+EVENT_TIMEOUT = 8 # 超时设置变更，重新放入时间轮
+
+DRAIN_CHECK_INTERVAL = 0.1 # 平滑退出期间检查未完成请求的间隔秒数
+STATS_INTERVAL = 1.0 # IO处理进程发布共享内存统计的间隔秒数
+
+# 热路径中的日志开关，先判断再格式化日志字符串，由update_log_guards()按日志级别设置
+LOG_DEBUG = logging.getLogger().isEnabledFor(logging.DEBUG)
+LOG_INFO = logging.getLogger().isEnabledFor(logging.INFO)
+TRACER = None # 二进制环形缓冲跟踪器(server.trace.Tracer)，IO处理进程中设置了trace_file时创建
+
+def update_log_guards():
+    '''
+    按根日志的当前级别设置热路径中的日志开关，IO处理进程启动时调用，运行中改变日志级别后需要重新调用
+    '''
+    global LOG_DEBUG, LOG_INFO
+    logger = logging.getLogger()
+    LOG_DEBUG = logger.isEnabledFor(logging.DEBUG)
+    LOG_INFO = logger.isEnabledFor(logging.INFO)
+
+def set_tracer(tracer):
+    global TRACER
+    TRACER = tracer
+
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') and 'SC_IOV_MAX' in os.sysconf_names else 1024 # 每次sendmsg()最多发送的缓冲数
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg') # 不支持sendmsg()的平台每次只发送一个缓冲
+WRITE_HIGH_WATERMARK = 256 * 1024 # 写队列超过该字节数时Session.wait_writable()阻塞调用线程
+WRITE_LOW_WATERMARK = 64 * 1024 # 写队列降到该字节数以下时唤醒Session.wait_writable()
+HAS_SENDFILE = hasattr(os, 'sendfile') # 不支持sendfile()的平台由Poller读出文件内容再发送
+SENDFILE_FALLBACK_SIZE = 64 * 1024 # 不支持sendfile()时每次读出的字节数
+
+class PollBackend:
+    '''
+    基于select.poll的轮询后端，每次轮询都要扫描全部描述符
+    '''
+    def __init__(self):
+        self._poll = select.poll()
+
+    def register(self, fd, events, level_triggered=False):
+        '''
+        level_triggered为True时，即使后端工作在边缘触发模式也使用水平触发
+        '''
+        self._poll.register(fd, events)
+
+    def modify(self, fd, events):
+        self._poll.modify(fd, events)
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout=None):
+        '''
+        timeout单位为秒，None表示一直阻塞
+        '''
+        return self._poll.poll(None if timeout is None else timeout * 1000)
+
+    def close(self):
+        pass
 
-RECV_BUFFER_SIZE = 1024 # 每次接收字节数
+class EpollBackend(PollBackend):
+    '''
+    基于select.epoll的轮询后端，只返回就绪的描述符，支持边缘触发
+    Linux下EPOLLIN/EPOLLOUT等取值与POLLIN/POLLOUT相同，事件掩码无需转换
+    '''
+    def __init__(self, edge_triggered=False):
+        self._poll = select.epoll()
+        self.edge_triggered = edge_triggered
+        self.__flags = select.EPOLLET if edge_triggered else 0
+
+    def register(self, fd, events, level_triggered=False):
+        self._poll.register(fd, events if level_triggered else events | self.__flags)
+
+    def modify(self, fd, events):
+        # 边缘触发模式下，modify会重新检查描述符状态，已就绪的事件会再次通知
+        self._poll.modify(fd, events | self.__flags)
+
+    def poll(self, timeout=None):
+        return self._poll.poll(-1 if timeout is None else timeout)
+
+    def close(self):
+        self._poll.close()
+
+POLL_BACKENDS = {'poll': PollBackend, 'epoll': EpollBackend} # 可选的轮询后端
+
+class RecvBuffer:
+    '''
+    IO处理进程共用的可重用接收缓冲，recv_into()直接写入，避免每次接收都分配新的bytes对象
+    缓冲大小根据实际读取的字节数在[min_size, max_size]之间自适应调整
+    '''
+    def __init__(self, min_size, max_size):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.__resize(min_size)
+        self.__average = 0 # 每次读取字节数的指数移动平均
+
+    def __resize(self, size):
+        # 总是重新分配，而不是原地调整，decode仍持有的旧memoryview不受影响
+        self.size = size
+        self.__view = memoryview(bytearray(size))
+
+    def recv(self, connection):
+        '''
+        返回本次读取数据的memoryview，只在下次recv之前有效，对端关闭时长度为0
+        '''
+        nbytes = connection.recv_into(self.__view)
+        data = self.__view[:nbytes]
+        self.__average += (nbytes - self.__average) / 8
+        if nbytes == self.size and self.size < self.max_size:
+            # 缓冲被读满，说明还有更多数据，加倍以减少系统调用次数
+            self.__resize(min(self.size * 2, self.max_size))
+        elif self.size > self.min_size and self.__average * 8 < self.size:
+            # 最近的读取普遍较小，逐步缩小以免长期占用大块内存
+            self.__resize(max(self.size // 2, self.min_size))
+        return data
+
+TIMER_TICK = 1.0 # 时间轮每格代表的秒数，即超时检查的精度
+TIMER_SLOTS = 512 # 时间轮格数，超过一圈的超时分多圈检查
+
+class TimerWheel:
+    '''
+    哈希时间轮，管理Session的超时
+    Session只在时间轮中占一格，活动只修改Session的最后活动时间，不需要操作时间轮；
+    到期检查时发现超时时刻已被顺延则重新放入对应的格子(惰性重置)，每格的处理是O(1)的
+    '''
+    def __init__(self, tick=TIMER_TICK, nr_slots=TIMER_SLOTS):
+        self.tick = tick
+        self.__slots = [set() for i in range(nr_slots)]
+        self.__slot_of = {} # session -> 所在格子
+        self.__current = 0
+        self.__next_tick = time.monotonic() + tick
+
+    def __len__(self):
+        return len(self.__slot_of)
+
+    def add(self, session):
+        '''
+        把session放入其超时时刻对应的格子，未设置超时的放在最远的格子中，一圈后再检查
+        '''
+        deadline = session.get_deadline()
+        nr_slots = len(self.__slots)
+        # 以当前格子代表的时刻计算，推进多格时已处理格子中的session也能落在正确的位置
+        ticks = nr_slots - 1 if deadline is None else int((deadline - self.__next_tick) / self.tick) + 2
+        index = (self.__current + max(1, min(ticks, nr_slots - 1))) % nr_slots
+        self.__slots[index].add(session)
+        self.__slot_of[session] = index
+
+    def remove(self, session):
+        index = self.__slot_of.pop(session, None)
+        if index is not None:
+            self.__slots[index].discard(session)
+
+    def get_timeout(self, now):
+        '''
+        距下一格到期的秒数，供poll()作为超时参数，时间轮为空时返回None
+        '''
+        if not self.__slot_of:
+            return None
+        return max(0, self.__next_tick - now)
+
+    def advance(self, now):
+        '''
+        推进时间轮，返回已超时的session列表，已超时的session同时从时间轮中移除
+        '''
+        expired = []
+        while now >= self.__next_tick:
+            self.__next_tick += self.tick
+            self.__current = (self.__current + 1) % len(self.__slots)
+            slot = self.__slots[self.__current]
+            self.__slots[self.__current] = set()
+            for session in slot:
+                deadline = session.get_deadline()
+                if deadline is not None and deadline <= now:
+                    del self.__slot_of[session]
+                    expired.append(session)
+                else:
+                    self.add(session)
+        return expired
+
+class FileRegion:
+    '''
+    写队列中的文件区间，由Poller以os.sendfile()从文件直接发送到socket，不读入用户态内存，不计入写队列的字节数
+    持有的描述符归本对象所有，发送完、链接移除或对象回收时关闭
+    '''
+    def __init__(self, fd, offset, count):
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+    
+    def __len__(self):
+        return self.count
+    
+    def advance(self, nsent):
+        self.offset += nsent
+        self.count -= nsent
+    
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+    
+    def __del__(self):
+        self.close()
 
 class Session:
     
@@ -202,10 +932,43 @@ class Session:
         self.__fd = fd
         self.__poller = poller
         self.__events = 0
+        self.__registered = False # 写队列清空后会撤销可写事件，__events为0时描述符仍可能处于注册状态
         self.__shut_rd = False
         self.__shut_wr = False
         self.__closed = False
+        self.__lock = threading.Lock() # 保护write_queue与__events的一致性，Poller线程与Executor线程共用
+        self.__writable = threading.Condition(self.__lock) # 写队列降到低水位或链接已移除时通知
+        self.__queued = 0 # 写队列中的字节数
+        self.__removed = False # Poller已移除链接
+        self.__timeout = None
+        self.__deadline = None
+        self.last_active = time.monotonic() # 最后一次收发数据的时间，只做赋值，不需要加锁
         self.attributes = {}
+    
+    def fileno(self):
+        return self.__fd
+    
+    def set_timeout(self, timeout, absolute=False):
+        '''
+        设置超时秒数，None表示不超时，超时后由Poller关闭链接并触发handler.timeout
+        默认从最后一次收发数据开始计时，有活动即顺延；absolute为True时从现在开始计时，活动不再顺延
+        '''
+        now = time.monotonic()
+        self.last_active = now
+        self.__deadline = now + timeout if absolute and timeout is not None else None
+        self.__timeout = timeout
+        if timeout is not None:
+            # 超时时刻可能提前，时间轮的惰性重置只能处理顺延，需要Poller重新放入时间轮
+            self.__request(EVENT_TIMEOUT)
+    
+    def get_deadline(self):
+        '''
+        超时时刻(time.monotonic())，不超时返回None
+        '''
+        timeout = self.__timeout
+        if timeout is None:
+            return None
+        return self.__deadline if self.__deadline is not None else self.last_active + timeout
         
     def recv_ready(self):
         '''
@@ -213,67 +976,169 @@ class Session:
         '''
         if self.__shut_rd or self.__closed:
             raise Exception('客户端[%s:%d]输入已经关闭' % self.client_address)
-        if not self.__events:
-            self.__events |= POLL_READ
-            self.__poller.request(self.__fd, EVENT_REGISTER, self.__events)
-        elif not self.__events & POLL_READ == POLL_READ:
-            self.__events |= POLL_READ
-            self.__poller.request(self.__fd, EVENT_MODIFY, self.__events)
+        self.last_active = time.monotonic()
+        with self.__lock:
+            if not self.__registered:
+                self.__registered = True
+                self.__events |= POLL_READ
+                self.__request(EVENT_REGISTER, self.__events)
+            elif not self.__events & POLL_READ == POLL_READ:
+                self.__events |= POLL_READ
+                self.__request(EVENT_MODIFY, self.__events)
     
     def write(self, bytes):
         if self.__shut_wr or self.__closed:
             raise Exception('客户端[%s:%d]输出已经关闭' % self.client_address)
-        logging.debug('向客户端[%s:%d]写数据' % self.client_address)
-        self.write_queue.append(bytes)
-        if not self.__events:
-            self.__events |= POLL_WRITE
-            self.__poller.request(self.__fd, EVENT_REGISTER, self.__events)
-        elif not self.__events & POLL_WRITE == POLL_WRITE:
-            self.__events |= POLL_WRITE
-            self.__poller.request(self.__fd, EVENT_MODIFY, self.__events)
+        if LOG_DEBUG:
+            logging.debug('向客户端[%s:%d]写数据' % self.client_address)
+        if TRACER:
+            TRACER.record(trace.TRACE_WRITE, self.__fd, len(bytes))
+        self.last_active = time.monotonic()
+        with self.__lock:
+            self.write_queue.append(bytes)
+            if not isinstance(bytes, FileRegion):
+                self.__queued += len(bytes)
+            if not self.__registered:
+                self.__registered = True
+                self.__events |= POLL_WRITE
+                self.__request(EVENT_REGISTER, self.__events)
+            elif not self.__events & POLL_WRITE == POLL_WRITE:
+                self.__events |= POLL_WRITE
+                self.__request(EVENT_MODIFY, self.__events)
+    
+    def get_events(self):
+        '''
+        当前关注的事件，Poller以此为准，避免执行过期的EVENT_MODIFY请求
+        关闭后写队列中可能还有数据未发送，此时仍需关注可写事件
+        '''
+        with self.__lock:
+            return self.__events | POLL_WRITE if self.write_queue else self.__events
+    
+    def get_write_buffers(self, max_buffers):
+        '''
+        由Poller调用，返回写队列头部最多max_buffers个缓冲，不从队列中移除
+        遇到FileRegion时截止，FileRegion在头部时只返回它，由Poller以sendfile()单独发送
+        Executor线程可能同时在队尾追加，遍历deque必须加锁
+        '''
+        with self.__lock:
+            buffers = []
+            for buffer in itertools.islice(self.write_queue, max_buffers):
+                if isinstance(buffer, FileRegion):
+                    return buffers or [buffer]
+                buffers.append(buffer)
+            return buffers
+    
+    def consume(self, nsent):
+        '''
+        由Poller在发送之后调用，弹出已经完整发送的缓冲，部分发送的缓冲以memoryview记录偏移，不复制剩余数据
+        '''
+        with self.__lock:
+            write_queue = self.write_queue
+            while write_queue:
+                buffer = write_queue[0]
+                size = len(buffer)
+                if nsent < size:
+                    if isinstance(buffer, FileRegion):
+                        buffer.advance(nsent)
+                    elif nsent:
+                        write_queue[0] = memoryview(buffer)[nsent:]
+                        self.__queued -= nsent
+                    break
+                write_queue.popleft()
+                if isinstance(buffer, FileRegion):
+                    buffer.close()
+                else:
+                    self.__queued -= size
+                nsent -= size
+            if self.__queued <= WRITE_LOW_WATERMARK:
+                self.__writable.notify_all()
+    
+    def wait_writable(self, timeout=None):
+        '''
+        由Executor线程在流式输出时调用，写队列超过WRITE_HIGH_WATERMARK字节时阻塞，直到降到WRITE_LOW_WATERMARK以下
+        超时或链接已断开时返回False
+        '''
+        with self.__writable:
+            if self.__queued > WRITE_HIGH_WATERMARK:
+                self.__writable.wait_for(lambda: self.__removed or self.__queued <= WRITE_LOW_WATERMARK, timeout)
+            return not self.__removed and self.__queued <= WRITE_HIGH_WATERMARK
+    
+    def removed(self):
+        '''
+        由Poller在移除链接后调用，唤醒wait_writable()
+        '''
+        with self.__lock:
+            self.__removed = True
+            self.__writable.notify_all()
+            [buffer.close() for buffer in self.write_queue if isinstance(buffer, FileRegion)]
+    
+    def __request(self, event, poll_events=None):
+        '''
+        链接移除后描述符可能已被新链接重用，不再提交请求，流式输出的Executor线程写完或关闭时会走到这里
+        '''
+        if not self.__removed:
+            self.__poller.request(self.__fd, event, poll_events, self)
+    
+    def write_drained(self):
+        '''
+        由Poller在写队列清空后调用，撤销可写事件并返回新的事件掩码
+        描述符几乎总是可写的，不撤销的话水平触发会空转，边缘触发则收不到后续写入的通知
+        '''
+        with self.__lock:
+            if self.write_queue:
+                return None
+            self.__events &= ~POLL_WRITE
+            return self.__events
     
     def shutdown(self, how):
         if self.__closed:
             raise Exception('客户端[%s:%d]已经关闭' % self.client_address)
-        orig_events = self.__events
-        event = 0
-        if how is socket.SHUT_RD:
-            if self.__shut_rd:
-                raise Exception('客户端[%s:%d]输入已经关闭' % self.client_address)
-            logging.debug('关闭客户端[%s:%d]输入' % self.client_address)
-            self.__events &= ~POLL_READ
-            self.__shut_rd = True
-            event = EVENT_SHUT_RD
-        elif how is socket.SHUT_WR:
-            if self.__shut_wr:
-                raise Exception('客户端[%s:%d]输出已经关闭' % self.client_address)
-            logging.debug('关闭客户端[%s:%d]输出' % self.client_address)
-            self.__events &= ~POLL_WRITE
-            self.__shut_wr = True
-            event = EVENT_SHUT_WR
-        elif how is socket.SHUT_RDWR:
-            if self.__shut_rd or self.__shut_wr:
-                raise Exception('客户端[%s:%d]输入和输出已经关闭' % self.client_address)
-            logging.debug('关闭客户端[%s:%d]输入输出' % self.client_address)
-            self.__events = 0
-            self.__shut_rd = True
-            self.__shut_wr = True
-            event = EVENT_SHUT_RDWR
-        if orig_events and not self.__events:
-            self.__poller.request(self.__fd, EVENT_UNREGISTER)
-        else:
-            self.__poller.request(self.__fd, EVENT_MODIFY, self.__events)
-        self.__poller.request(self.__fd, event)
+        with self.__lock:
+            event = 0
+            if how is socket.SHUT_RD:
+                if self.__shut_rd:
+                    raise Exception('客户端[%s:%d]输入已经关闭' % self.client_address)
+                if LOG_DEBUG:
+                    logging.debug('关闭客户端[%s:%d]输入' % self.client_address)
+                self.__events &= ~POLL_READ
+                self.__shut_rd = True
+                event = EVENT_SHUT_RD
+            elif how is socket.SHUT_WR:
+                if self.__shut_wr:
+                    raise Exception('客户端[%s:%d]输出已经关闭' % self.client_address)
+                if LOG_DEBUG:
+                    logging.debug('关闭客户端[%s:%d]输出' % self.client_address)
+                self.__events &= ~POLL_WRITE
+                self.__shut_wr = True
+                event = EVENT_SHUT_WR
+            elif how is socket.SHUT_RDWR:
+                if self.__shut_rd or self.__shut_wr:
+                    raise Exception('客户端[%s:%d]输入和输出已经关闭' % self.client_address)
+                if LOG_DEBUG:
+                    logging.debug('关闭客户端[%s:%d]输入输出' % self.client_address)
+                self.__events = 0
+                self.__shut_rd = True
+                self.__shut_wr = True
+                event = EVENT_SHUT_RDWR
+            if self.__registered and not self.__events:
+                self.__registered = False
+                self.__request(EVENT_UNREGISTER)
+            elif self.__registered:
+                self.__request(EVENT_MODIFY, self.__events)
+            self.__request(event)
     
     def close(self):
         if self.__closed:
             raise Exception('客户端[%s:%d]已经关闭' % self.client_address)
-        logging.debug('关闭客户端[%s:%d]' % self.client_address)
-        self.__closed = True
-        if self.__events:
-            self.__poller.request(self.__fd, EVENT_UNREGISTER)
-        self.__events = 0
-        self.__poller.request(self.__fd, EVENT_CLOSE)
+        if LOG_DEBUG:
+            logging.debug('关闭客户端[%s:%d]' % self.client_address)
+        with self.__lock:
+            self.__closed = True
+            if self.__registered:
+                self.__registered = False
+                self.__request(EVENT_UNREGISTER)
+            self.__events = 0
+            self.__request(EVENT_CLOSE)
 
 
 class Poller:
@@ -283,14 +1148,56 @@ class Poller:
     def __init__(self, server):
         self.__server = server
         self.__requests = queue.deque()
-        self.__poller = select.poll()
+        self.__poller = server.create_poll_backend()
+        self.__edge_triggered = server.edge_triggered
+        self.__recv_buffer = RecvBuffer(server.recv_buffer_size, server.max_recv_buffer_size)
+        self.__timer_wheel = TimerWheel()
+        self.__paused = set() # Executor队列饱和时暂停读取的描述符
+        self.__resume_pending = False
         self.__connections = {}
         self.__sessions = {}
         self.__alive = False
+        # 唤醒通道(self-pipe)，Executor线程提交请求后唤醒阻塞在poll()上的Poller线程
+        self.__wakeup_fds = os.pipe()
+        [os.set_blocking(fd, False) for fd in self.__wakeup_fds]
+        self.__wakeup_pending = False
+        self.__dump_stats = False
+        self.__exit_requested = False
+        self.__drain_deadline = None # 开始平滑退出后不再accept，处理完未完成的请求或到期后退出
+        self.nr_accepts = 0 # 本进程accept的链接数，用于确认各IO处理进程负载是否均衡
+        self.nr_requests = 0 # 本进程交给handler的请求数，达到max_requests后平滑退出
     
-    def request(self, fd, event, poll_events=None):
-        logging.debug('提交异步请求[%d, %d, %s]' % (fd, event, str(poll_events)))
-        self.__requests.append((fd, event, poll_events))
+    def request(self, fd, event, poll_events=None, session=None):
+        if LOG_DEBUG:
+            logging.debug('提交异步请求[%d, %d, %s]' % (fd, event, str(poll_events)))
+        if TRACER:
+            TRACER.record(trace.TRACE_REQUEST, fd, event)
+        self.__requests.append((fd, event, poll_events, session))
+        self.wakeup()
+    
+    def wakeup(self):
+        '''
+        唤醒Poller线程，已有未处理的唤醒时不再重复写管道
+        '''
+        if self.__wakeup_pending:
+            return
+        self.__wakeup_pending = True
+        try:
+            os.write(self.__wakeup_fds[1], b'\0')
+        except BlockingIOError:
+            pass # 管道已满，说明Poller线程必然会被唤醒
+    
+    def __handle_wakeup_event(self):
+        '''
+        清空唤醒管道，请求统一在本轮循环末尾处理
+        必须先读管道再清除标志，否则读管道与清除标志之间设置的标志对应的字节已被读走，后续请求将不再唤醒
+        '''
+        try:
+            while os.read(self.__wakeup_fds[0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+        self.__wakeup_pending = False
         
     def __do_request(self):
         '''
@@ -298,9 +1205,9 @@ class Poller:
         '''
         redo_requests = []
         while True:
-            fd, event, poll_events = (None, None, None)
+            fd, event, poll_events, session = (None, None, None, None)
             try:
-                fd, event, poll_events = self.__requests.popleft()
+                fd, event, poll_events, session = self.__requests.popleft()
             except IndexError as e:
                 break
             try:
@@ -308,58 +1215,84 @@ class Poller:
                 if not connection:
                     logging.warn('客户端描述符[%d]已被删除' % fd)
                     continue
+                if session is not None and self.__sessions[fd] is not session:
+                    # 提交请求之后链接被移除，描述符又被新链接重用
+                    logging.warn('客户端描述符[%d]已被新链接重用，忽略之前链接的请求' % fd)
+                    continue
+                if event is EVENT_TIMEOUT:
+                    session = self.__sessions[fd]
+                    self.__timer_wheel.remove(session)
+                    self.__timer_wheel.add(session)
+                    continue
                 if event is EVENT_REGISTER:
-                    logging.debug('注册描述符事件[%d:%d]' % (fd, POLL_ERROR | poll_events))
-                    self.__poller.register(connection, POLL_ERROR | poll_events)
+                    poll_events = self.__poll_events(fd, self.__sessions[fd].get_events())
+                    if LOG_DEBUG:
+                        logging.debug('注册描述符事件[%d:%d]' % (fd, POLL_ERROR | poll_events))
+                    try:
+                        self.__poller.register(fd, POLL_ERROR | poll_events)
+                    except FileExistsError:
+                        # 之前的EVENT_UNREGISTER因数据未发送被推迟，描述符仍处于注册状态
+                        self.__poller.modify(fd, POLL_ERROR | poll_events)
                     continue
                 if event is EVENT_MODIFY:
-                    logging.debug('修改描述符事件[%d:%d]' % (fd, POLL_ERROR | poll_events))
-                    self.__poller.modify(connection, POLL_ERROR | poll_events)
+                    poll_events = self.__poll_events(fd, self.__sessions[fd].get_events())
+                    if LOG_DEBUG:
+                        logging.debug('修改描述符事件[%d:%d]' % (fd, POLL_ERROR | poll_events))
+                    self.__poller.modify(fd, POLL_ERROR | poll_events)
                     continue
                 if event is EVENT_UNREGISTER:
-                    logging.debug('撤销描述符事件[%d]' % fd)
+                    if LOG_DEBUG:
+                        logging.debug('撤销描述符事件[%d]' % fd)
                     # 检查是否还有数据未发送
                     session = self.__sessions[fd]
                     if session.write_queue:
-                        logging.debug('该描述符[%d]还有数据未发送，推迟执行' % fd)
-                        redo_requests.append((fd, event, poll_events))
+                        if LOG_DEBUG:
+                            logging.debug('该描述符[%d]还有数据未发送，推迟执行' % fd)
+                        redo_requests.append((fd, event, poll_events, session))
                         continue
-                    self.__poller.unregister(connection)
+                    self.__poller.unregister(fd)
                     continue
                 if event is EVENT_SHUT_RD:
                     connection.shutdown(socket.SHUT_RD)
                     continue
                 if event is EVENT_SHUT_WR:
-                    logging.debug('关闭描述符[%d]输出' % fd)
+                    if LOG_DEBUG:
+                        logging.debug('关闭描述符[%d]输出' % fd)
                     # 检查是否还有数据未发送
                     session = self.__sessions[fd]
                     if session.write_queue:
-                        logging.debug('该描述符[%d]还有数据未发送，推迟执行' % fd)
-                        redo_requests.append((fd, event, poll_events))
+                        if LOG_DEBUG:
+                            logging.debug('该描述符[%d]还有数据未发送，推迟执行' % fd)
+                        redo_requests.append((fd, event, poll_events, session))
                         continue
                     connection.shutdown(socket.SHUT_WR)
                     continue
                 if event is EVENT_SHUT_RDWR:
-                    logging.debug('关闭描述符[%d]输入和输出' % fd)
+                    if LOG_DEBUG:
+                        logging.debug('关闭描述符[%d]输入和输出' % fd)
                     # 检查是否还有数据未发送
                     session = self.__sessions[fd]
                     if session.write_queue:
-                        logging.debug('该描述符[%d]还有数据未发送，推迟执行' % fd)
-                        redo_requests.append((fd, event, poll_events))
+                        if LOG_DEBUG:
+                            logging.debug('该描述符[%d]还有数据未发送，推迟执行' % fd)
+                        redo_requests.append((fd, event, poll_events, session))
                         continue
                     connection.shutdown(socket.SHUT_RDWR)
                     continue
                 if event is EVENT_CLOSE:
-                    logging.debug('关闭描述符[%d]' % fd)
+                    if LOG_DEBUG:
+                        logging.debug('关闭描述符[%d]' % fd)
                     # 检查是否还有数据未发送
                     session = self.__sessions[fd]
                     if session.write_queue:
-                        logging.debug('该描述符[%d]还有数据未发送，推迟执行' % fd)
-                        redo_requests.append((fd, event, poll_events))
+                        if LOG_DEBUG:
+                            logging.debug('该描述符[%d]还有数据未发送，推迟执行' % fd)
+                        redo_requests.append((fd, event, poll_events, session))
                         continue
                     connection.close()
-                    del self.__connections[fd]
-                    del self.__sessions[fd]
+                    if TRACER:
+                        TRACER.record(trace.TRACE_CLOSE, fd)
+                    self.__remove_session(fd)
                     continue
                 logging.warn('未知请求[%d]' % fd)
             except Exception as e:
@@ -367,92 +1300,263 @@ class Poller:
                 traceback.print_exc()
         self.__requests.extend(redo_requests)
         
+    def __request_dump_stats(self, signum, frame):
+        '''
+        SIGUSR1信号处理，只设置标志，由Poller线程输出统计，避免在信号处理中调用logging
+        '''
+        self.__dump_stats = True
+        self.wakeup()
+    
+    def __request_graceful_exit(self, signum, frame):
+        '''
+        SIGTERM信号处理，由Poller线程开始平滑退出
+        '''
+        self.__exit_requested = True
+        self.wakeup()
+    
+    def __start_draining(self, reason):
+        logging.info('IO处理进程[%s, pid=%d]%s，停止accept并开始平滑退出' % (str(self.__server.worker_id), os.getpid(), reason))
+        self.__drain_deadline = time.monotonic() + self.__server.graceful_timeout
+        server_socket = self.__server.server_socket
+        self.__poller.unregister(server_socket.fileno())
+        # 共享服务端socket时只关闭本进程的描述符，其它IO处理进程继续accept
+        server_socket.close()
+    
+    def __drained(self):
+        '''
+        Executor中的请求都已处理完，响应都已发送
+        '''
+        if time.monotonic() >= self.__drain_deadline:
+            logging.warning('IO处理进程[%s, pid=%d]平滑退出超时' % (str(self.__server.worker_id), os.getpid()))
+            return True
+        if self.__requests or not self.__server.executor.is_idle():
+            return False
+        if any(session.write_queue for session in self.__sessions.values()):
+            return False
+        is_idle = getattr(self.__server.handler, 'is_idle', None)
+        return not is_idle or all(is_idle(session) for session in self.__sessions.values())
+    
+    def dump_stats(self):
+        self.__server.dump_stats(self.nr_accepts, self.nr_requests, len(self.__connections), len(self.__paused))
+    
     def __handle_server_event(self, event):
         '''
         服务端描述符事件 
         '''
         if event & (select.POLLIN | select.POLLPRI):
-            connection, client_address = self.__server.server_socket.accept() # 新的链接
-            logging.debug('[%s:%d]链接本服务器' % client_address)
-            connection.setblocking(False)
-            fileno = connection.fileno()
-            self.__connections[fileno] = connection
-            session = Session(client_address, fileno, self)
-            self.__sessions[fileno] = session
-            self.__server.executor.execute(self.__server.handler.connect, session) # 触发链接事件
+            # 一次事件最多accept accept_batch个链接，链接风暴时尽快清空backlog，又不至于让已有链接饿死
+            for i in range(self.__server.accept_batch):
+                try:
+                    connection, client_address = self.__server.server_socket.accept() # 新的链接
+                except BlockingIOError:
+                    # backlog已清空，或者共享服务端socket时链接已被其它IO处理进程抢先accept
+                    return
+                except OSError as e:
+                    # 描述符耗尽等错误，留待下次事件再accept
+                    logging.error(e)
+                    return
+                self.__accept(connection, client_address)
         elif event & POLL_ERROR:
             # 服务端描述符发生错误
             logging.error('服务端描述符被挂起或发生错误')
             self.__alive = False
-            self.__poller.unregister(self.__server.server_socket)
+            self.__poller.unregister(self.__server.server_socket.fileno())
             self.__server.server_socket.close()
             
+    def __accept(self, connection, client_address):
+        self.nr_accepts += 1
+        if LOG_DEBUG:
+            logging.debug('[%s:%d]链接本服务器' % client_address)
+        connection.setblocking(False)
+        fileno = connection.fileno()
+        if TRACER:
+            TRACER.record(trace.TRACE_ACCEPT, fileno, self.nr_accepts)
+        self.__connections[fileno] = connection
+        session = Session(client_address, fileno, self)
+        self.__sessions[fileno] = session
+        session.set_timeout(self.__server.idle_timeout)
+        self.__timer_wheel.add(session)
+        self.__server.executor.execute(self.__server.handler.connect, session) # 触发链接事件
+            
     def __handle_client_readable(self, connection, session):
         '''
         客户端可读
         '''
-        logging.debug('读取客户端[%s:%d]发送的数据' % session.client_address)
+        if LOG_DEBUG:
+            logging.debug('读取客户端[%s:%d]发送的数据' % session.client_address)
         client_shut = False
+        executor = self.__server.executor
         while True:
+            if not self.__server.shed_load and executor.is_saturated():
+                # Executor处理不过来，暂停读取，请求留在内核缓冲中，由TCP流控反压到客户端
+                self.__pause_reading(connection.fileno(), session)
+                break
             try:
-                bytes = connection.recv(RECV_BUFFER_SIZE)
+                size = self.__recv_buffer.size
+                bytes = self.__recv_buffer.recv(connection)
                 if bytes:
+                    session.last_active = time.monotonic()
                     requests = self.__server.decode(session, bytes)
+                    if TRACER:
+                        TRACER.record(trace.TRACE_RECV, connection.fileno(), len(bytes))
+                        if requests:
+                            TRACER.record(trace.TRACE_DECODE, connection.fileno(), len(requests))
                     if requests:
                         for data in requests:
-                            logging.info('接收到客户端[%s:%d]的完整请求' % session.client_address)
-                            self.__server.executor.execute(self.__server.handler.recv, session, data) # 触发数据到达事件
+                            if LOG_INFO:
+                                logging.info('接收到客户端[%s:%d]的完整请求' % session.client_address)
+                            if self.__server.shed_load and executor.is_saturated():
+                                self.__server.handler.reject(session, data) # 直接拒绝，不进入Executor队列
+                                continue
+                            self.nr_requests += 1
+                            if TRACER:
+                                TRACER.record(trace.TRACE_EXECUTE, connection.fileno(), executor.jobs.qsize())
+                            executor.execute(self.__server.handler.recv, session, data) # 触发数据到达事件
+                    if len(bytes) < size and not self.__edge_triggered:
+                        # 没有读满说明内核缓冲已空，水平触发模式下省去一次必然返回EAGAIN的recv
+                        # 边缘触发模式下数据之后的FIN不会再次通知，必须读到EAGAIN
+                        break
                 else:
                     client_shut = True
                     break
             except BlockingIOError:
                 break
         if client_shut:
-            logging.info('客户端[%s:%d]输出终止' % session.client_address)
-            self.__poller.modify(connection, POLL_ERROR)
+            if LOG_INFO:
+                logging.info('客户端[%s:%d]输出终止' % session.client_address)
+            self.__poller.modify(connection.fileno(), POLL_ERROR)
             self.__server.executor.execute(self.__server.handler.close, session) # 触发客户端关闭事件
     
+    def __poll_events(self, fd, events):
+        '''
+        暂停读取的描述符不关注可读事件
+        '''
+        return events & ~POLL_READ if fd in self.__paused else events
+    
+    def __pause_reading(self, fd, session):
+        if LOG_DEBUG:
+            logging.debug('Executor队列饱和，暂停读取客户端[%s:%d]' % session.client_address)
+        if TRACER:
+            TRACER.record(trace.TRACE_PAUSE, fd)
+        self.__paused.add(fd)
+        self.__poller.modify(fd, POLL_ERROR | self.__poll_events(fd, session.get_events()))
+    
+    def __request_resume(self):
+        '''
+        Executor队列降到低水位时由Executor线程调用
+        '''
+        self.__resume_pending = True
+        self.wakeup()
+    
+    def __resume_reading(self):
+        if self.__server.executor.is_saturated():
+            return
+        if LOG_DEBUG:
+            logging.debug('Executor队列恢复，继续读取[%d]个客户端' % len(self.__paused))
+        if TRACER:
+            TRACER.record(trace.TRACE_RESUME, -1, len(self.__paused))
+        paused = self.__paused
+        self.__paused = set()
+        for fd in paused:
+            session = self.__sessions.get(fd)
+            if session:
+                # 边缘触发模式下modify会重新检查描述符状态，内核缓冲中的数据会再次通知
+                self.__poller.modify(fd, POLL_ERROR | session.get_events())
+    
     def __handle_client_writable(self, connection, session):
         '''
         客户端可写
         '''
-        while True:
-            bytes = None
-            try:
-                bytes = session.write_queue.popleft()
-            except IndexError as e:
-                break
-            if bytes:
+        write_queue = session.write_queue
+        while write_queue:
+            # 一次sendmsg()发送队列头部的多个缓冲，HttpHandler的状态行、各个Header和Body只需一次系统调用
+            buffers = session.get_write_buffers(IOV_MAX)
+            if LOG_DEBUG:
                 logging.debug('向客户端[%s:%d]写数据' % session.client_address)
-                nsent = connection.send(bytes)
+            try:
+                if isinstance(buffers[0], FileRegion):
+                    nsent = self.__sendfile(connection, buffers[0])
+                else:
+                    nsent = connection.sendmsg(buffers) if HAS_SENDMSG else connection.send(buffers[0])
+            except BlockingIOError:
+                return
+            if LOG_DEBUG:
                 logging.debug('向客户端[%s:%d]写入[%d]字节' % (session.client_address[0], session.client_address[1], nsent))
-                if nsent < len(bytes):
+            if TRACER:
+                TRACER.record(trace.TRACE_SEND, connection.fileno(), nsent)
+            session.last_active = time.monotonic()
+            session.consume(nsent)
+            if nsent < sum(len(b) for b in buffers):
+                if LOG_DEBUG:
                     logging.debug('本次还有剩余字节未写入')
-                    # 提出未发送的数据放回write_queue中
-                    session.write_queue.appendleft(bytes[nsent:])
-                    break
+                return
+        events = session.write_drained()
+        if events is not None:
+            fd = connection.fileno()
+            if TRACER:
+                TRACER.record(trace.TRACE_DRAINED, fd)
+            self.__poller.modify(fd, POLL_ERROR | self.__poll_events(fd, events))
+    
+    def __sendfile(self, connection, region):
+        if HAS_SENDFILE:
+            nsent = os.sendfile(connection.fileno(), region.fd, region.offset, region.count)
+        else:
+            nsent = connection.send(os.pread(region.fd, min(region.count, SENDFILE_FALLBACK_SIZE), region.offset))
+        if not nsent:
+            # 文件在发送期间被截断，响应已经不完整，只能断开链接
+            logging.warning('文件[%d]在发送期间被截断，还有%d字节未发送' % (region.fd, region.count))
+            raise ConnectionAbortedError()
+        return nsent
     
     def __handle_client_error(self, fd, connection, session):
         '''
         客户端错误
         '''
         logging.warning('客户端[%s:%d]发生错误' % session.client_address)
-        self.__poller.unregister(connection)
+        try:
+            self.__poller.unregister(fd)
+        except (KeyError, FileNotFoundError):
+            pass # 已撤销注册
         connection.close()
         self.__server.executor.execute(self.__server.handler.error, session) # 触发错误事件
-        del self.__connections[fd]
-        del self.__sessions[fd]
+        self.__remove_session(fd)
     
     def __handle_client_hup(self, fd, connection, session):
         '''
         客户端强行关闭
         '''
         logging.warning('客户端[%s:%d]强行关闭' % session.client_address)
-        self.__poller.unregister(connection)
+        try:
+            self.__poller.unregister(fd)
+        except (KeyError, FileNotFoundError):
+            pass # 已撤销注册
         connection.close()
         self.__server.executor.execute(self.__server.handler.hup, session) # 触发强行关闭事件
+        self.__remove_session(fd)
+    
+    def __handle_client_timeout(self, session):
+        '''
+        客户端超时
+        '''
+        fd = session.fileno()
+        if LOG_INFO:
+            logging.info('客户端[%s:%d]超时' % session.client_address)
+        if TRACER:
+            TRACER.record(trace.TRACE_TIMEOUT, fd)
+        try:
+            self.__poller.unregister(fd)
+        except (KeyError, FileNotFoundError):
+            pass # 尚未注册或已撤销注册
+        self.__connections[fd].close()
+        self.__server.executor.execute(self.__server.handler.timeout, session) # 触发超时事件
+        self.__remove_session(fd)
+    
+    def __remove_session(self, fd):
         del self.__connections[fd]
-        del self.__sessions[fd]
+        self.__paused.discard(fd)
+        session = self.__sessions.pop(fd)
+        self.__timer_wheel.remove(session)
+        session.removed()
     
     def __handle_client_event(self, fd, event):
         '''
@@ -460,12 +1564,18 @@ class Poller:
         '''
         connection = self.__connections[fd]
         session = self.__sessions[fd]
-        if event & (select.POLLIN | select.POLLPRI):
-            # 可读
-            self.__handle_client_readable(connection, session)
-        elif event & select.POLLOUT:
-            # 可写
-            self.__handle_client_writable(connection, session)
+        # 可读和可写可能同时发生，边缘触发模式下漏掉任何一个都不会再次通知
+        if event & (select.POLLIN | select.POLLPRI | select.POLLOUT):
+            try:
+                if event & (select.POLLIN | select.POLLPRI):
+                    # 可读
+                    self.__handle_client_readable(connection, session)
+                if event & select.POLLOUT:
+                    # 可写
+                    self.__handle_client_writable(connection, session)
+            except ConnectionError:
+                # 对端已重置链接或发送的文件被截断，写队列不会再减少，不处理的话会一直报告可写，流式输出的Executor线程也等不到唤醒
+                self.__handle_client_hup(fd, connection, session)
         elif event & select.POLLERR:
             # 客户端错误
             self.__handle_client_error(fd, connection, session)
@@ -474,15 +1584,35 @@ class Poller:
             self.__handle_client_hup(fd, connection, session)
         
     def start(self):
-        self.__poller.register(self.__server.server_socket, POLL_READ | POLL_ERROR)
+        # 服务端描述符始终使用水平触发，每次事件最多accept accept_batch个链接，backlog中剩余的链接在下次poll时继续accept
+        self.__poller.register(self.__server.server_socket.fileno(), POLL_READ | POLL_ERROR, level_triggered=True)
+        self.__poller.register(self.__wakeup_fds[0], POLL_READ, level_triggered=True)
+        signal.signal(signal.SIGUSR1, self.__request_dump_stats)
+        signal.signal(signal.SIGTERM, self.__request_graceful_exit)
+        self.__server.executor.add_drain_listener(self.__request_resume)
         server_fileno = self.__server.server_socket.fileno()
+        wakeup_fileno = self.__wakeup_fds[0]
+        max_requests = self.__server.max_requests
+        publish_time = time.monotonic() if self.__server.stats else None # 下次发布统计的时间
         self.__alive = True
         while self.__alive:
-            timeouts = None if not self.__connections else 0
-            events = self.__poller.poll(timeouts)
+            # 有异步请求时由唤醒通道通知，无需轮询，只需按时间轮的精度检查超时
+            now = time.monotonic()
+            timeout = self.__timer_wheel.get_timeout(now)
+            if publish_time is not None:
+                timeout = max(0, publish_time - now) if timeout is None else min(timeout, max(0, publish_time - now))
+            if self.__drain_deadline is not None:
+                # Executor执行完任务不一定提交请求，平滑退出期间需要定时检查
+                timeout = DRAIN_CHECK_INTERVAL if timeout is None else min(timeout, DRAIN_CHECK_INTERVAL)
+            events = self.__poller.poll(timeout)
+            if TRACER:
+                TRACER.record(trace.TRACE_POLL, -1, len(events))
             for fd, event in events:
                 try:
-                    if fd is server_fileno:
+                    if fd == wakeup_fileno:
+                        # 唤醒事件
+                        self.__handle_wakeup_event()
+                    elif fd == server_fileno:
                         # 服务端事件
                         self.__handle_server_event(event)
                     else:
@@ -493,3 +1623,28 @@ class Poller:
                     traceback.print_exc()
             # 处理Session提交的异步请求
             self.__do_request()
+            if self.__resume_pending:
+                self.__resume_pending = False
+                self.__resume_reading()
+            # 关闭超时的链接
+            for session in self.__timer_wheel.advance(time.monotonic()):
+                try:
+                    self.__handle_client_timeout(session)
+                except Exception as e:
+                    logging.error(e)
+                    traceback.print_exc()
+            if self.__dump_stats:
+                self.__dump_stats = False
+                self.dump_stats()
+            if publish_time is not None and time.monotonic() >= publish_time:
+                publish_time += STATS_INTERVAL
+                self.__server.publish_stats(self.nr_accepts, self.nr_requests, len(self.__connections), len(self.__paused))
+            if self.__drain_deadline is None:
+                if self.__exit_requested:
+                    self.__start_draining('收到退出信号')
+                elif max_requests is not None and self.nr_requests >= max_requests:
+                    self.__start_draining('已处理%d个请求' % self.nr_requests)
+            elif self.__drained():
+                break
+        for connection in self.__connections.values():
+            connection.close()
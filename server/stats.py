@@ -0,0 +1,191 @@
+'''
+IO处理进程共享内存统计
+主进程在Fork之前创建统计文件并映射到内存，每个IO处理进程只写自己编号对应的槽位，不加锁
+写入时用seqlock保护：先把序号加1(奇数表示正在写)，写完所有字段后再加1，读取时序号为奇数或前后不一致就重读
+
+用法(在项目根目录下执行): python -m server.stats <统计文件> [刷新间隔秒数]
+'''
+import mmap
+import os, sys
+import struct
+import time
+
+__all__ = ['StatsSegment']
+
+MAGIC = b'NIOSTAT2'
+HEADER = struct.Struct('=8sII') # magic, 槽位数, 槽位字节数
+WAIT_BUCKETS = 16 # 排队等待时间直方图的桶数，第0个桶为1毫秒以下，第i个桶为[2^(i-1), 2^i)毫秒，最后一个桶不设上限
+
+# 槽位字段，顺序即存储顺序
+FIELDS = (
+    ('seq', 'Q'), # seqlock序号
+    ('pid', 'q'),
+    ('worker_id', 'q'),
+    ('updated', 'd'), # 最后一次发布的时间(time.time())
+    ('accepts', 'Q'),
+    ('requests', 'Q'),
+    ('connections', 'Q'),
+    ('paused', 'Q'),
+    ('threads', 'Q'),
+    ('idle_threads', 'Q'),
+    ('depth', 'Q'),
+    ('max_depth', 'Q'),
+    ('jobs', 'Q'),
+    ('saturated', 'Q'),
+    ('avg_wait', 'd'),
+    ('max_wait', 'd'),
+    ('reused', 'Q'), # 复用已有链接的请求数，由handler.get_stats()提供
+    ('limit_closed', 'Q'), # 达到单个链接最大请求数而关闭的链接数
+)
+FIELD_NAMES = tuple(name for name, format in FIELDS)
+SLOT = struct.Struct('=' + ''.join(format for name, format in FIELDS) + '%dQ' % WAIT_BUCKETS)
+SEQ = struct.Struct('=Q')
+
+READ_RETRIES = 100 # 读取槽位时与写入冲突的最多重试次数
+
+class StatsSegment:
+
+    def __init__(self, buffer, nr_slots):
+        self.buffer = buffer
+        self.nr_slots = nr_slots
+        self.__seqs = [0] * nr_slots # 只在写入槽位的进程中使用
+
+    @classmethod
+    def create(cls, path, nr_slots):
+        '''
+        由主进程在Fork之前调用，先写临时文件再改名，重启后旧IO处理进程仍写旧文件，不会与新IO处理进程冲突
+        '''
+        if nr_slots < 1:
+            raise ValueError('参数[nr_slots]不能小于1')
+        size = HEADER.size + SLOT.size * nr_slots
+        tmp_path = '%s.%d' % (path, os.getpid())
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            buffer = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(buffer, 0, MAGIC, nr_slots, SLOT.size)
+        os.replace(tmp_path, path)
+        return cls(buffer, nr_slots)
+
+    @classmethod
+    def open(cls, path):
+        '''
+        只读方式打开统计文件，供监控使用
+        '''
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, nr_slots, slot_size = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or slot_size != SLOT.size:
+            buffer.close()
+            raise ValueError('文件[%s]不是统计文件或版本不一致' % path)
+        return cls(buffer, nr_slots)
+
+    def publish(self, slot, values, wait_histogram):
+        '''
+        写入槽位，每个槽位只能由一个进程写
+        '''
+        offset = HEADER.size + SLOT.size * slot
+        seq = self.__seqs[slot] + 1
+        SEQ.pack_into(self.buffer, offset, seq) # 奇数，正在写
+        SLOT.pack_into(self.buffer, offset, seq, *([values.get(name, 0) for name in FIELD_NAMES[1:]] + list(wait_histogram)))
+        self.__seqs[slot] = seq + 1
+        SEQ.pack_into(self.buffer, offset, seq + 1)
+
+    def read(self, slot):
+        '''
+        读取槽位的一致快照，从未写入过的槽位返回None
+        '''
+        offset = HEADER.size + SLOT.size * slot
+        for i in range(READ_RETRIES):
+            seq = SEQ.unpack_from(self.buffer, offset)[0]
+            if seq & 1:
+                time.sleep(0)
+                continue
+            data = SLOT.unpack_from(self.buffer, offset)
+            if SEQ.unpack_from(self.buffer, offset)[0] != seq or data[0] != seq:
+                continue
+            if not seq:
+                return None
+            values = dict(zip(FIELD_NAMES, data))
+            values['wait_histogram'] = list(data[len(FIELD_NAMES):])
+            return values
+        return None
+
+    def read_all(self):
+        return [self.read(slot) for slot in range(self.nr_slots)]
+
+    def close(self):
+        self.buffer.close()
+
+def aggregate(slots):
+    '''
+    汇总各IO处理进程的统计，计数累加，最大值取最大，平均值按任务数加权
+    '''
+    total = {name: 0 for name in FIELD_NAMES[4:]}
+    total['wait_histogram'] = [0] * WAIT_BUCKETS
+    for values in slots:
+        if values is None:
+            continue
+        for name in total:
+            if name == 'wait_histogram':
+                total[name] = [a + b for a, b in zip(total[name], values[name])]
+            elif name in ('max_depth', 'max_wait'):
+                total[name] = max(total[name], values[name])
+            elif name != 'avg_wait':
+                total[name] += values[name]
+        total['avg_wait'] += values['avg_wait'] * values['jobs']
+    if total['jobs']:
+        total['avg_wait'] /= total['jobs']
+    return total
+
+def wait_percentile(histogram, percent):
+    '''
+    由直方图估算排队等待时间的百分位，返回所在桶的上限毫秒数，最后一个桶返回None
+    '''
+    count = sum(histogram)
+    if not count:
+        return 0
+    remain = count * percent / 100
+    for i, n in enumerate(histogram):
+        remain -= n
+        if remain <= 0:
+            return 2 ** i if i < WAIT_BUCKETS - 1 else None
+    return None
+
+def format_row(name, values, total_requests, now):
+    p99 = wait_percentile(values['wait_histogram'], 99)
+    return '%-8s %7s %6s %9d %6.1f%% %6.1f%% %6d %6d %8d %6s %8d %9.2f %9s %8s' % (name,
+            values.get('pid', '-'), '%.0fs' % (now - values['updated']) if 'updated' in values else '-',
+            values['requests'], values['requests'] * 100 / total_requests if total_requests else 0,
+            values['reused'] * 100 / values['requests'] if values['requests'] else 0,
+            values['connections'], values['paused'], values['threads'] - values['idle_threads'], '%d/%d' % (values['depth'], values['max_depth']),
+            values['jobs'], values['avg_wait'] * 1000, '<%dms' % p99 if p99 is not None else '>%dms' % 2 ** (WAIT_BUCKETS - 2),
+            'yes' if values['saturated'] else '')
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    segment = StatsSegment.open(sys.argv[1])
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    try:
+        while True:
+            slots = segment.read_all()
+            total = aggregate(slots)
+            now = time.time()
+            print('%-8s %7s %6s %9s %7s %7s %6s %6s %8s %6s %8s %9s %9s %8s' % ('worker', 'pid', 'age', 'requests', 'share', 'reuse', 'conns', 'paused', 'busy', 'queue', 'jobs', 'avg_ms', 'p99_wait', 'saturated'))
+            for slot, values in enumerate(slots):
+                if values is not None:
+                    print(format_row(str(slot), values, total['requests'], now))
+            print(format_row('total', total, total['requests'], now))
+            print()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        segment.close()
+
+if __name__ == '__main__':
+    main()
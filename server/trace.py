@@ -0,0 +1,107 @@
+'''
+IO处理进程的二进制环形缓冲跟踪
+每个IO处理进程映射一个固定大小的跟踪文件，热路径上每个事件只写一条定长记录，不格式化字符串、不加锁、不做系统调用
+缓冲写满后从头覆盖，文件始终保留最近capacity条记录，进程运行中或崩溃后都可以直接读取
+
+用法(在项目根目录下执行): python -m server.trace <跟踪文件> [最多输出条数]
+'''
+import itertools
+import mmap
+import os, sys
+import struct
+from time import monotonic_ns
+
+__all__ = ['Tracer']
+
+MAGIC = b'NIOTRAC1'
+HEADER = struct.Struct('=8sII') # magic, 记录条数上限, 记录字节数
+RECORD = struct.Struct('=QHiq') # time.monotonic_ns(), 事件, 描述符, 事件参数，时间为0表示空记录
+
+DEFAULT_CAPACITY = 65536 # 默认保留的记录条数
+
+# 跟踪事件
+TRACE_ACCEPT = 1 # 新链接，参数为本进程accept的链接数
+TRACE_RECV = 2 # 读取数据，参数为字节数
+TRACE_DECODE = 3 # 解码出完整请求，参数为请求数
+TRACE_EXECUTE = 4 # 请求提交给Executor，参数为提交时的队列深度
+TRACE_WRITE = 5 # Session.write()，参数为字节数
+TRACE_SEND = 6 # sendmsg()，参数为发送的字节数
+TRACE_DRAINED = 7 # 写队列清空
+TRACE_REQUEST = 8 # Session提交异步请求，参数为请求类型(nioserver.EVENT_*)
+TRACE_CLOSE = 9 # 关闭描述符
+TRACE_TIMEOUT = 10 # 链接超时
+TRACE_PAUSE = 11 # Executor饱和，暂停读取
+TRACE_RESUME = 12 # 恢复读取，参数为恢复的链接数
+TRACE_POLL = 13 # poll()返回，参数为事件数，描述符为-1
+
+EVENT_NAMES = {
+    TRACE_ACCEPT: 'accept',
+    TRACE_RECV: 'recv',
+    TRACE_DECODE: 'decode',
+    TRACE_EXECUTE: 'execute',
+    TRACE_WRITE: 'write',
+    TRACE_SEND: 'send',
+    TRACE_DRAINED: 'drained',
+    TRACE_REQUEST: 'request',
+    TRACE_CLOSE: 'close',
+    TRACE_TIMEOUT: 'timeout',
+    TRACE_PAUSE: 'pause',
+    TRACE_RESUME: 'resume',
+    TRACE_POLL: 'poll',
+}
+
+class Tracer:
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY):
+        '''
+        创建并映射跟踪文件，已存在时覆盖
+        '''
+        if capacity < 1:
+            raise ValueError('参数[capacity]不能小于1')
+        self.path = path
+        self.capacity = capacity
+        size = HEADER.size + RECORD.size * capacity
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.buffer = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self.buffer, 0, MAGIC, capacity, RECORD.size)
+        # 每条记录的偏移预先算好循环使用，next()在GIL下是原子的，Poller线程和Executor线程可以同时记录
+        self.__offsets = itertools.cycle(range(HEADER.size, size, RECORD.size))
+        self.__pack = RECORD.pack_into
+
+    def record(self, event, fd=-1, value=0):
+        self.__pack(self.buffer, next(self.__offsets), monotonic_ns(), event, fd, value)
+
+    def close(self):
+        self.buffer.close()
+
+def read_records(path):
+    '''
+    按时间顺序返回跟踪文件中的记录 (纳秒时间, 事件, 描述符, 参数)
+    环形缓冲不记录写入位置，按时间排序即可恢复顺序
+    '''
+    with open(path, 'rb') as f:
+        buffer = f.read()
+    magic, capacity, record_size = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError('文件[%s]不是跟踪文件或版本不一致' % path)
+    return sorted(record for record in RECORD.iter_unpack(buffer[HEADER.size:HEADER.size + RECORD.size * capacity]) if record[0])
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    records = read_records(sys.argv[1])
+    if len(sys.argv) > 2:
+        records = records[-int(sys.argv[2]):]
+    if not records:
+        return
+    begin = records[0][0]
+    for ns, event, fd, value in records:
+        print('%12.6f %-8s %6d %d' % ((ns - begin) / 1e9, EVENT_NAMES.get(event, str(event)), fd, value))
+
+if __name__ == '__main__':
+    main()
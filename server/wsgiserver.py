@@ -1,11 +1,17 @@
 import collections
 import io
 import logging
+import re
 import socket
 import sys, os
+import tempfile
+import threading
 import traceback
 import urllib.parse
+import uuid
+import zlib
 import server.nioserver as server
+import server.aioserver as aioserver
 
 __all__ = ['HTTPServer']
 
@@ -13,12 +19,44 @@ SERVER_PROTOCOL_VERSION = 'HTTP/1.1'
 SERVER_VERSION_NUMBER = (1, 1) # 不支持低版本的http协议
 
 DEFAULT_PORT = 8000
+DEFAULT_HEADER_TIMEOUT = 10 # 读取请求头的超时秒数，从请求的第一个字节开始计时，防止slowloris之类的慢速攻击
+DEFAULT_BODY_TIMEOUT = 30 # 读取请求体时两次接收之间的超时秒数
+DEFAULT_KEEPALIVE_TIMEOUT = 15 # 响应完成后等待下一个请求的空闲超时秒数
+DEFAULT_STREAM_THRESHOLD = 64 * 1024 # 响应体超过该字节数时先发出响应头，之后边产生边发送，否则整体发送并给出Content-Length
+DEFAULT_SEND_TIMEOUT = 30 # 流式响应等待客户端接收的最长秒数
+DEFAULT_MAX_KEEPALIVE_REQUESTS = 1000 # 单个链接最多处理的请求数，之后关闭链接，让客户端重新链接，链接在IO处理进程间重新分布
+DEFAULT_MAX_HEADER_SIZE = 64 * 1024 # 请求头的最大字节数，超过后返回431并关闭链接
+DEFAULT_BODY_SPOOL_SIZE = 1024 * 1024 # 请求体不超过该字节数时保存在内存中，超过后写入临时文件
+DEFAULT_FILE_BLOCK_SIZE = 64 * 1024 # wsgi.file_wrapper不能sendfile时每次读出的字节数
+DEFAULT_COMPRESS_MIN_SIZE = 1024 # 响应体不小于该字节数时才压缩，None表示不压缩
+DEFAULT_COMPRESS_LEVEL = 6 # zlib压缩级别，在Executor线程中边产生边压缩，不用最高级别
+# 压缩的Content-Type，图片、字体等本身已压缩的类型不再压缩
+DEFAULT_COMPRESS_TYPES = frozenset(('text/html', 'text/css', 'text/plain', 'text/xml', 'text/javascript', 'text/csv',
+        'application/javascript', 'application/json', 'application/xml', 'image/svg+xml'))
+CONTENT_ENCODINGS = {'gzip': 31, 'deflate': 15} # 内容编码 -> zlib的wbits，HTTP的deflate是带zlib头的格式
+MAX_RANGES = 16 # Range请求头最多的区间数，超过时忽略Range返回完整响应，防止大量小区间放大开销
+DEFAULT_ENGINE = 'nio'
+
+# 服务器引擎，nio为自带的Poller，asyncio为asyncio事件循环(安装了uvloop时使用uvloop)
+ENGINES = {
+    'nio': server.NIOServer,
+    'asyncio': aioserver.AIOServer,
+}
 
 class HTTPServer:
 
-    def __init__(self, port=DEFAULT_PORT, application=None):
+    def __init__(self, port=DEFAULT_PORT, application=None, header_timeout=DEFAULT_HEADER_TIMEOUT, body_timeout=DEFAULT_BODY_TIMEOUT, keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT, max_header_size=None, max_keepalive_requests=DEFAULT_MAX_KEEPALIVE_REQUESTS, **options):
+        '''
+        options原样传给NIOServer，例如 poller='epoll', edge_triggered=True
+        '''
         self.set_port(port)
         self.set_application(application)
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.max_header_size = max_header_size or DEFAULT_MAX_HEADER_SIZE
+        self.max_keepalive_requests = max_keepalive_requests
+        self.options = options
         
     def set_port(self, port):
         if port is None or port < 1:
@@ -30,16 +68,24 @@ class HTTPServer:
             raise ValueError('参数[application]不能为空')
         self.application = application
         
-    def start(self):
+    def start(self, engine=DEFAULT_ENGINE):
+        '''
+        engine选择服务器引擎，见ENGINES
+        '''
+        if engine not in ENGINES:
+            raise ValueError('参数[engine]只能是%s之一' % ', '.join(ENGINES))
         env = {}
         env['SERVER_PROTOCOL'] = SERVER_PROTOCOL_VERSION
         env['SERVER_NAME'] = ''     # 暂为空
         env['SERVER_PORT'] = self.port
-        s = server.NIOServer(address=('', self.port), 
+        # 平时只保留2个线程，处理较慢(如SQLite查询)的请求排队时最多增加到16个
+        options = {'exec_nr_threads': 16, 'exec_min_threads': 2}
+        options.update(self.options)
+        s = ENGINES[engine](address=('', self.port), 
                         sockopts=((socket.SOL_SOCKET, socket.SO_REUSEADDR, 1),), 
-                        decode = lambda session, bytes: parse_request(session, bytes), 
-                        exec_nr_threads=8, 
-                        handler=HttpHandler(self.application, env))
+                        decode = lambda session, bytes: parse_request(session, bytes, self.header_timeout, self.body_timeout, self.max_header_size), 
+                        handler=HttpHandler(self.application, env, self.header_timeout, self.keepalive_timeout, self.max_keepalive_requests), 
+                        **options)
         s.daemonize()
         s.start()
 
@@ -50,16 +96,30 @@ class HttpRequest:
         self.version = None
         self.headers = {}
         self.input = None
+        self.seq = 0 # 同一链接上的请求序号，响应按序号写出
     
 class DecodeCtx:
     def __init__(self):
-        self.match_crlf = False
+        self.buffer = bytearray() # 还未解释的请求头字节，跨多次接收累积
+        self.scanned = 0 # buffer中已查找过请求头结束标志的长度，下次接收后从这里往前3个字节开始查找
         self.request = None
-        self.line = bytearray()
         self.input_remain = 0
+        self.chunked = False # 请求体为chunked编码
+        self.chunk_state = CHUNK_SIZE
+        self.chunk_remain = 0 # 当前chunk还需接收的字节数
+        self.body_size = 0 # 已接收的chunked请求体字节数
+
+HEADER_END = b'\r\n\r\n'
+MAX_CHUNK_LINE = 4096 # chunk大小行、trailer行的最大字节数
+# int()还接受0x前缀、正负号、下划线和空白，前端代理按另一种方式解释时会造成请求走私，只允许纯数字
+CHUNK_SIZE_PATTERN = re.compile(rb'[0-9A-Fa-f]+')
+DIGITS_PATTERN = re.compile(r'[0-9]+')
 
-CR = 13
-LF = 10
+# chunked请求体的解码状态
+CHUNK_SIZE = 0 # 等待chunk大小行
+CHUNK_DATA = 1 # 接收chunk数据
+CHUNK_DATA_END = 2 # 等待chunk数据之后的\r\n
+CHUNK_TRAILER = 3 # 最后一个chunk之后，等待trailer或结束的空行
 
 def parse_request_line(line):
     '''
@@ -96,86 +156,651 @@ def parse_request_header(line):
     else:
         logging.warn('不能识别请求头[%s]' % line)
         raise Exception
+
+def parse_request_head(head):
+    '''
+    解释完整的请求头(不含结尾的空行)
+    '''
+    lines = head.decode().split('\r\n')
+    request = parse_request_line(lines[0])
+    for line in lines[1:]:
+        name, value = parse_request_header(line)
+        name = name.upper()
+        # 重复且不一致的Content-Length无法确定请求体的边界，可能被用来走私请求
+        if name == 'CONTENT-LENGTH' and request.headers.get(name, value).strip() != value.strip():
+            raise ValueError('Content-Length不一致')
+        request.headers[name] = value
+    return request
+
+class ResponseSequencer:
+    '''
+    流水线请求的响应排序，每个链接一个
+    同一链接上解码出的多个请求由Executor的多个线程同时处理，响应按请求到达的顺序写出
+    排在最前面的响应边产生边写出，后面的响应先暂存，轮到时再写出
+    解码器(Poller线程)和处理器(Executor线程)对decode_ctx和超时的修改都在锁内进行，避免处理器设置的keepalive超时覆盖新请求的请求头超时
+    '''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__nr_requests = 0 # 已解码的请求数，即下一个请求的序号
+        self.__next = 0 # 正在写出的响应序号
+        self.__pending = {} # 序号 -> [暂存的输出, 是否已完成, 是否关闭链接]
+        self.closing = False # 已决定关闭链接，不再解码后续请求
+        self.__closed = False # 已关闭链接，之后的输出直接丢弃
     
-def parse_request(session, bytes):
-    if not bytes:
-        return None
-    if not session.attributes.get('decode_ctx'):
-        session.attributes['decode_ctx'] = DecodeCtx()
-    ctx = session.attributes['decode_ctx']
+    def start_request(self, session, header_timeout):
+        with self.__lock:
+            ctx = session.attributes['decode_ctx'] = DecodeCtx()
+            # 新请求开始，请求头必须在header_timeout内接收完整，期间的活动不顺延
+            session.set_timeout(header_timeout, absolute=True)
+            return ctx
     
-    if ctx.input_remain > 0:
-        blen = len(bytes)
-        if blen < ctx.input_remain:
-            ctx.request.input.write(bytes)
-            ctx.input_remain -= blen
-            return None
-        ctx.request.input.write(bytes[0: ctx.input_remain]) # 应该没有多余的字节，对不遵守Http协议的客户端不予支持
-        ctx.input_remain = 0
-        del session.attributes['decode_ctx']
-        return (ctx.request,)
+    def end_request(self, session, request):
+        '''
+        请求解码完成，分配序号
+        '''
+        with self.__lock:
+            request.seq = self.__nr_requests
+            self.__nr_requests += 1
+            del session.attributes['decode_ctx']
+            session.set_timeout(None) # 请求交给Executor处理，处理期间不超时
     
-    result = []
-    bytes = bytearray(bytes)
+    def reject(self, session, output):
+        '''
+        不能解码的请求，在之前的响应之后写出错误响应并关闭链接
+        '''
+        with self.__lock:
+            seq = self.__nr_requests
+            self.__nr_requests += 1
+            session.attributes.pop('decode_ctx', None)
+            self.closing = True
+        self.respond(session, seq, (output,), True)
+    
+    def write(self, session, seq, outputs):
+        '''
+        写出序号为seq的部分响应，之前还有响应未完成时暂存
+        返回是否已直接写出，链接已关闭时返回False
+        '''
+        with self.__lock:
+            if self.__closed:
+                return False
+            if seq != self.__next:
+                self.__pending.setdefault(seq, [[], False, False])[0].extend(outputs)
+                return False
+            for output in outputs:
+                if output:
+                    session.write(output)
+            return True
+    
+    def finish(self, session, seq, close_conn, keepalive_timeout=None):
+        '''
+        序号为seq的响应已全部输出，轮到之后暂存的响应时写出
+        '''
+        with self.__lock:
+            if self.__closed:
+                return
+            entry = self.__pending.setdefault(seq, [[], False, False])
+            entry[1] = True
+            entry[2] = close_conn
+            while self.__next in self.__pending:
+                outputs, finished, close_conn = entry = self.__pending[self.__next]
+                for output in outputs:
+                    if output:
+                        session.write(output)
+                entry[0] = []
+                if not finished:
+                    return # 之后的输出直接写出
+                del self.__pending[self.__next]
+                self.__next += 1
+                if close_conn:
+                    self.__close(session)
+                    return
+                session.attributes['keepalive'] = True
+            if self.__next < self.__nr_requests:
+                return
+            if self.closing:
+                self.__close(session) # 客户端已关闭输出，所有响应都已写出
+            elif keepalive_timeout is not None and 'decode_ctx' not in session.attributes:
+                session.set_timeout(keepalive_timeout) # 等待下一个请求
+    
+    def respond(self, session, seq, outputs, close_conn, keepalive_timeout=None):
+        '''
+        写出序号为seq的完整响应
+        '''
+        self.write(session, seq, outputs)
+        self.finish(session, seq, close_conn, keepalive_timeout)
+    
+    def close(self, session):
+        '''
+        客户端关闭输出，写完已接收请求的响应后关闭链接
+        '''
+        with self.__lock:
+            self.closing = True
+            if not self.__closed and self.__next >= self.__nr_requests:
+                self.__close(session)
+    
+    def __close(self, session):
+        self.closing = True
+        self.__closed = True
+        self.__pending.clear()
+        session.close()
+    
+    def is_pending(self):
+        return self.__next < self.__nr_requests
+
+def parse_chunked(ctx, data):
+    '''
+    解码chunked请求体，数据写入ctx.request.input
+    请求体接收完整时返回之后多余的字节(属于下一个请求)，否则返回None，格式错误时抛出异常
+    '''
+    while data:
+        if ctx.chunk_state == CHUNK_DATA:
+            chunk = data[:ctx.chunk_remain]
+            ctx.request.input.write(chunk)
+            ctx.chunk_remain -= len(chunk)
+            ctx.body_size += len(chunk)
+            data = data[len(chunk):]
+            if not ctx.chunk_remain:
+                ctx.chunk_state = CHUNK_DATA_END
+            continue
+        # 其它状态都是按行解释，行可能跨多次接收，只把行所需的字节复制到ctx.buffer中
+        buffer = ctx.buffer
+        start = max(len(buffer) - 1, 0)
+        used = len(buffer)
+        buffer += data[:MAX_CHUNK_LINE]
+        end = buffer.find(b'\r\n', start)
+        if end < 0:
+            if len(buffer) >= MAX_CHUNK_LINE:
+                raise ValueError('chunk行超过%d字节' % MAX_CHUNK_LINE)
+            return None
+        data = data[end + 2 - used:]
+        line = bytes(buffer[:end])
+        ctx.buffer = bytearray()
+        if ctx.chunk_state == CHUNK_SIZE:
+            size, sep, extension = line.partition(b';') # 忽略chunk扩展
+            if sep:
+                size = size.rstrip(b' \t') # 扩展的分号之前可以有空白
+            if not CHUNK_SIZE_PATTERN.fullmatch(size):
+                raise ValueError('chunk大小[%r]格式错误' % size)
+            size = int(size, 16)
+            if size:
+                ctx.chunk_remain = size
+                ctx.chunk_state = CHUNK_DATA
+            else:
+                ctx.chunk_state = CHUNK_TRAILER
+        elif ctx.chunk_state == CHUNK_DATA_END:
+            if line:
+                raise ValueError('chunk数据之后不是\\r\\n')
+            ctx.chunk_state = CHUNK_SIZE
+        elif not line:
+            return data # trailer结束，请求体完整
+        # trailer中的头忽略
+    return None
+
+def parse_request(session, bytes, header_timeout=DEFAULT_HEADER_TIMEOUT, body_timeout=DEFAULT_BODY_TIMEOUT, max_header_size=DEFAULT_MAX_HEADER_SIZE, body_spool_size=DEFAULT_BODY_SPOOL_SIZE):
+    '''
+    增量解码，返回本次接收后完整的所有请求，不完整的部分留在DecodeCtx中
+    请求头累积在DecodeCtx.buffer中，每次接收后只从上次查找结束的位置查找\\r\\n\\r\\n，请求头完整后一次解释
+    请求体按Content-Length或chunked编码接收，不超过body_spool_size字节时保存在内存中，超过后写入临时文件
+    '''
+    if not bytes:
+        return None
+    sequencer = session.attributes.get('sequencer')
+    if not sequencer:
+        sequencer = session.attributes['sequencer'] = ResponseSequencer()
+    if sequencer.closing:
+        return None
+    requests = []
     while bytes:
-        b = bytes.pop(0)
-        if b not in (CR, LF):
-            # 普通字节，根据Http协议，在请求头中，不会出现单一CR或LF的情况
-            if ctx.match_crlf:
-                ctx.match_crlf = False
-            ctx.line.append(b)
+        ctx = session.attributes.get('decode_ctx')
+        if not ctx:
+            ctx = sequencer.start_request(session, header_timeout)
+        
+        if ctx.chunked:
+            try:
+                bytes = parse_chunked(ctx, bytes)
+            except Exception as e:
+                logging.warn('客户端[%s:%d]chunked请求体格式错误: %s' % (session.client_address + (e,)))
+                sequencer.reject(session, ('%s 400 Bad Request\r\nConnection: close\r\n\r\n' % SERVER_PROTOCOL_VERSION).encode())
+                break
+            if bytes is None:
+                break
+            # 应用按Content-Length读取请求体
+            ctx.request.headers['CONTENT-LENGTH'] = str(ctx.body_size)
+            ctx.request.input.seek(0)
+            sequencer.end_request(session, ctx.request)
+            requests.append(ctx.request)
             continue
-        if b == CR:
+        
+        if ctx.input_remain > 0:
+            body = bytes[:ctx.input_remain]
+            ctx.request.input.write(body)
+            ctx.input_remain -= len(body)
+            if ctx.input_remain:
+                break
+            bytes = bytes[len(body):]
+            ctx.request.input.seek(0)
+            sequencer.end_request(session, ctx.request)
+            requests.append(ctx.request)
             continue
-        # b == LF的情况
-        if not ctx.match_crlf:
-            # 匹配一行
-            ctx.match_crlf = True
-            if not ctx.request:
-                try:
-                    ctx.request = parse_request_line(ctx.line.decode())
-                except Exception:
-                    session.write(('%s 400 Bad Request\r\nConnection: close\r\n\r\n' % SERVER_PROTOCOL_VERSION).encode())
-                    del session.attributes['decode_ctx']
-                    session.close()
-                    return None
+        
+        buffer = ctx.buffer
+        buffer += bytes
+        # 结束标志可能跨两次接收，从上次已查找部分的最后3个字节开始
+        end = buffer.find(HEADER_END, max(ctx.scanned - 3, 0))
+        # 结束标志与超长的请求头在同一次接收中到达时也要拒绝
+        if end > max_header_size or end < 0 and len(buffer) > max_header_size:
+            logging.warn('客户端[%s:%d]请求头超过%d字节' % (session.client_address + (max_header_size,)))
+            sequencer.reject(session, ('%s 431 Request Header Fields Too Large\r\nConnection: close\r\n\r\n' % SERVER_PROTOCOL_VERSION).encode())
+            break
+        if end < 0:
+            ctx.scanned = len(buffer)
+            break
+        try:
+            ctx.request = parse_request_head(buffer[:end])
+            # 同时有Transfer-Encoding和Content-Length时以Transfer-Encoding为准
+            transfer_encoding = ctx.request.headers.get('TRANSFER-ENCODING')
+            if transfer_encoding is not None:
+                if transfer_encoding.split(',')[-1].strip().lower() != 'chunked':
+                    raise ValueError('不支持Transfer-Encoding[%s]' % transfer_encoding)
+                ctx.chunked = True
+                ctlen = 0
             else:
+                content_length = ctx.request.headers.get('CONTENT-LENGTH', '0').strip()
+                if not DIGITS_PATTERN.fullmatch(content_length):
+                    raise ValueError('Content-Length[%s]格式错误' % content_length)
+                ctlen = int(content_length)
+        except Exception:
+            sequencer.reject(session, ('%s 400 Bad Request\r\nConnection: close\r\n\r\n' % SERVER_PROTOCOL_VERSION).encode())
+            break
+        # 请求头之后的字节属于请求体或下一个请求
+        bytes = buffer[end + len(HEADER_END):]
+        ctx.buffer = None
+        # 支持 Expect: 100-Continue，之前还有响应未写出时不发送，以免插在响应之间，客户端等待超时后会直接发送请求体
+        if ctx.request.headers.get('EXPECT', '').lower() == '100-Continue'.lower() and not sequencer.is_pending():
+            session.write(('%s 100 Continue\r\n\r\n' % SERVER_PROTOCOL_VERSION).encode())
+        if ctx.chunked or ctlen:
+            ctx.request.input = tempfile.SpooledTemporaryFile(body_spool_size)
+            session.set_timeout(body_timeout) # 请求体按两次接收之间的空闲时间计算超时
+        if ctx.chunked:
+            ctx.buffer = bytearray()
+            continue
+        # 解释Http头，如果有Content-Length，则继续接收数据，否则
+        if ctlen:
+            ctx.input_remain = ctlen # 还需接收 Content-Length 个字节
+            continue
+        sequencer.end_request(session, ctx.request)
+        requests.append(ctx.request)
+    return requests or None
+        
+LAST_CHUNK = b'0\r\n\r\n'
+
+def encode_chunk(data):
+    '''
+    返回chunked编码的一个chunk，分成三段交给Session.write，不复制数据
+    '''
+    return (b'%x\r\n' % len(data), data, b'\r\n')
+
+def choose_encoding(accept_encoding, encodings=('gzip', 'deflate')):
+    '''
+    按Accept-Encoding选出内容编码，encodings中靠前的优先，q=0表示不接受，返回None表示不压缩
+    '''
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, sep, params = item.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, sep, value = param.partition('=')
+            if key.strip().lower() == 'q':
                 try:
-                    name, value = parse_request_header(ctx.line.decode())
-                    ctx.request.headers[name.upper()] = value
-                except Exception:
-                    session.write(('%s 400 Bad Request\r\nConnection: close\r\n\r\n' % SERVER_PROTOCOL_VERSION).encode())
-                    del session.attributes['decode_ctx']
-                    session.close()
-                    return None
-            ctx.line = bytearray()
-        else:
-            # 此时说明匹配一个Http请求，包括Header
-            ctx.match_crlf = False
-            # 支持 Expect: 100-Continue
-            if ctx.request.headers.get('EXPECT', '').lower() == '100-Continue'.lower():
-                session.write(('%s 100 Continue\r\n\r\n' % SERVER_PROTOCOL_VERSION).encode())
-            # 解释Http头，如果有Content-Length，则继续接收数据，否则
-            ctlen = int(ctx.request.headers.get('CONTENT-LENGTH', '0'))
-            if ctlen:
-                ctx.input_remain = ctlen # 还需接收 Content-Length 个字节
-                ctx.request.input = io.BytesIO()
-                blen = len(bytes)
-                if blen < ctx.input_remain:
-                    ctx.request.input.write(bytes)
-                    ctx.input_remain -= blen
-                    return None
-                ctx.request.input.write(bytes[0: ctx.input_remain])
-                ctx.input_remain = 0
-            del session.attributes['decode_ctx']
-            return (ctx.request,)
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
     return None
-        
+
+def is_compressible(content_type, compress_types=DEFAULT_COMPRESS_TYPES):
+    return content_type is not None and content_type.split(';', 1)[0].strip().lower() in compress_types
+
+def parse_range(value, size):
+    '''
+    解析Range请求头，返回按起点排序、合并了重叠和相邻区间的[(起点, 终点)]，终点包含在内
+    格式错误、不是bytes单位或区间过多时返回None，按完整响应处理；没有可满足的区间时返回空列表
+    '''
+    unit, sep, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes' or not sep:
+        return None
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition('-')
+        first, last = first.strip(), last.strip()
+        # isdigit()对¹²³等非ASCII数字也返回True，int()却不能转换
+        if not sep or first and not DIGITS_PATTERN.fullmatch(first) or last and not DIGITS_PATTERN.fullmatch(last) or not first and not last:
+            return None
+        if first:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            end = int(last) if last else size - 1
+        else:
+            # 最后n个字节
+            start = max(size - int(last), 0)
+            end = size - 1 if int(last) else -1
+        if start >= size or end < start:
+            continue # 不可满足的区间
+        ranges.append((start, min(end, size - 1)))
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+class FileWrapper:
+    '''
+    wsgi.file_wrapper，应用返回本对象时，有描述符的文件由Session以sendfile发送，从文件的当前位置发送到末尾
+    被中间件包装等不能sendfile的情况下按可迭代对象每次读出block_size字节
+    '''
+    def __init__(self, filelike, block_size=DEFAULT_FILE_BLOCK_SIZE):
+        self.filelike = filelike
+        self.block_size = block_size
+    
+    def fileno(self):
+        '''
+        文件描述符，不是真实文件时返回None
+        '''
+        try:
+            return self.filelike.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None
+    
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.block_size), b'')
+    
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+class ResponseStream:
+    '''
+    一个请求的响应输出，由HttpHandler在Executor线程中使用
+    响应体不超过stream_threshold字节时整体发送并给出Content-Length；超过后先发出响应头，之后每次写入都立即交给Session，
+    没有Content-Length时按chunked编码，写队列超过高水位时阻塞应用线程，由客户端的接收速度反压
+    '''
+    def __init__(self, handler, session, request):
+        self.handler = handler
+        self.session = session
+        self.request = request
+        self.sequencer = session.attributes['sequencer']
+        self.status = (200, 'OK')
+        self.headers = {}
+        connection = request.headers.get('CONNECTION')
+        self.close_conn = connection is not None and connection.lower() == 'close'
+        self.body = [] # 发出响应头之前暂存的响应体片段
+        self.body_size = 0
+        self.committed = False # 响应头已发出
+        self.chunked = False
+        self.has_body = True # HEAD请求和1xx、204、304响应不发送响应体
+        self.compressor = None # 按Accept-Encoding压缩响应体时的zlib压缩对象
+    
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info is not None:
+            if self.committed:
+                raise exc_info[1].with_traceback(exc_info[2]) # 响应头已发出，不能再改为错误响应
+            self.headers = {}
+        if status is not None:
+            status = status.strip()
+            if len(status) == 3:
+                status = status + ' '
+            status = status.split(' ', 1)
+            self.status = (int(status[0]), status[1])
+        if headers is not None:
+            [self.headers.update({h: headers[h]}) for h in headers]
+        return self.write
+    
+    def write(self, obj):
+        data = obj if isinstance(obj, (bytes, bytearray, memoryview)) else str(obj).encode()
+        if not data:
+            return
+        if self.committed:
+            self.__send((data,))
+            return
+        self.body.append(data)
+        self.body_size += len(data)
+        if self.body_size > self.handler.stream_threshold:
+            self.__start_compression(self.body_size)
+            self.__commit(None)
+            body, self.body = self.body, []
+            self.__send(body)
+    
+    def finish(self):
+        '''
+        应用已输出全部响应体
+        '''
+        if not self.committed:
+            body = self.body
+            if self.__start_compression(self.body_size):
+                body = [self.compressor.compress(b''.join(body)) + self.compressor.flush()]
+            self.__commit(sum(len(piece) for piece in body))
+            if self.has_body:
+                self.sequencer.write(self.session, self.request.seq, body)
+        elif self.has_body:
+            if self.compressor:
+                self.__send((), True)
+            if self.chunked:
+                self.sequencer.write(self.session, self.request.seq, (LAST_CHUNK,))
+        self.sequencer.finish(self.session, self.request.seq, self.close_conn, self.handler.keepalive_timeout)
+    
+    def respond(self, data):
+        '''
+        应用直接返回完整响应体时调用，应用声明了Accept-Ranges时按Range只发送请求的区间
+        '''
+        data = data if isinstance(data, (bytes, bytearray, memoryview)) else str(data).encode()
+        if not self.committed and not self.body:
+            ranges = self.__select_ranges(len(data))
+            if ranges is not None:
+                self.__respond_ranges(len(data), ranges, lambda start, end: memoryview(data)[start:end + 1])
+                return
+        self.write(data)
+    
+    def sendfile(self, wrapper):
+        '''
+        应用返回FileWrapper时调用，已经输出过响应体或不是真实文件时返回False，由调用者按可迭代对象输出
+        文件区间交给Session后即返回，Session持有复制的描述符，应用可以立即关闭文件
+        '''
+        fd = wrapper.fileno()
+        if fd is None or self.committed or self.body:
+            return False
+        offset = wrapper.filelike.tell()
+        count = max(os.fstat(fd).st_size - offset, 0)
+        ranges = self.__select_ranges(count)
+        if ranges is not None:
+            self.__respond_ranges(count, ranges, lambda start, end: server.FileRegion(os.dup(fd), offset + start, end - start + 1))
+            return True
+        self.__commit(count)
+        if self.has_body and count:
+            self.__send((server.FileRegion(os.dup(fd), offset, count),))
+        return True
+    
+    def abort(self):
+        '''
+        应用出错，响应头还未发出时返回500，否则只能关闭链接，客户端由长度不足或缺少最后的chunk得知响应不完整
+        '''
+        if not self.committed:
+            self.sequencer.respond(self.session, self.request.seq,
+                    (('%s 500 Internal Server Error\r\nConnection: close\r\n\r\n' % SERVER_PROTOCOL_VERSION).encode(),), True)
+        else:
+            self.sequencer.finish(self.session, self.request.seq, True)
+    
+    def __start_compression(self, size):
+        '''
+        响应头发出之前调用，可压缩的响应按Accept-Encoding选择编码并创建压缩对象，返回是否压缩
+        wsgi.file_wrapper和区间响应不经过这里，静态文件由static预先压缩
+        '''
+        handler = self.handler
+        headers = self.headers
+        if handler.compress_min_size is None or self.status[0] != 200 or 'Content-Encoding' in headers \
+                or not is_compressible(headers.get('Content-Type'), handler.compress_types):
+            return False
+        # 可压缩的响应随Accept-Encoding不同，缓存需要区分
+        vary = headers.get('Vary')
+        if not vary:
+            headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            headers['Vary'] = vary + ', Accept-Encoding'
+        encoding = choose_encoding(self.request.headers.get('ACCEPT-ENCODING'))
+        if size < handler.compress_min_size or encoding is None or 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+        self.compressor = zlib.compressobj(handler.compress_level, zlib.DEFLATED, CONTENT_ENCODINGS[encoding])
+        headers['Content-Encoding'] = encoding
+        headers.pop('Content-Length', None) # 应用给出的是压缩前的长度
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            headers['ETag'] = 'W/' + etag # 压缩后不再逐字节相同，If-None-Match按弱比较仍能命中
+        return True
+    
+    def __select_ranges(self, size):
+        '''
+        应用以Accept-Ranges: bytes声明响应体支持区间请求时，按Range和If-Range选出要发送的区间
+        返回None表示发送完整响应
+        '''
+        request = self.request
+        value = request.headers.get('RANGE')
+        if value is None or request.method != 'GET' or self.status[0] != 200 or self.headers.get('Accept-Ranges') != 'bytes':
+            return None
+        if_range = request.headers.get('IF-RANGE')
+        if if_range is not None:
+            # If-Range按强比较，弱ETag不能用于区间请求，不一致说明客户端已有的部分已过期
+            if_range = if_range.strip()
+            if if_range.startswith('W/') or if_range not in (self.headers.get('ETag'), self.headers.get('Last-Modified')):
+                return None
+        return parse_range(value, size)
+    
+    def __respond_ranges(self, size, ranges, piece):
+        '''
+        发出206或416响应，piece(start, end)返回区间对应的输出，多个区间按multipart/byteranges发送
+        '''
+        self.headers.pop('Content-Length', None)
+        if not ranges:
+            self.status = (416, 'Requested Range Not Satisfiable')
+            self.headers['Content-Range'] = 'bytes */%d' % size
+            self.__commit(0)
+            return
+        self.status = (206, 'Partial Content')
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            self.__commit(end - start + 1)
+            self.__send((piece(start, end),))
+            return
+        boundary = uuid.uuid4().hex
+        content_type = self.headers.get('Content-Type')
+        self.headers['Content-Type'] = 'multipart/byteranges; boundary=' + boundary
+        outputs = []
+        for start, end in ranges:
+            part_head = '\r\n--%s\r\n' % boundary
+            if content_type:
+                part_head += 'Content-Type: %s\r\n' % content_type
+            part_head += 'Content-Range: bytes %d-%d/%d\r\n\r\n' % (start, end, size)
+            outputs.append(part_head.encode())
+            outputs.append(piece(start, end))
+        outputs.append(('\r\n--%s--\r\n' % boundary).encode())
+        self.__commit(sum(len(output) for output in outputs))
+        self.__send(outputs)
+    
+    def __commit(self, content_length):
+        '''
+        发出响应头，content_length为None表示长度未知
+        '''
+        status = self.status
+        head = ['%s %d %s\r\n' % (SERVER_PROTOCOL_VERSION, status[0], status[1])]
+        for header in self.headers.items():
+            if header[0] == 'Connection' and header[1].lower() == 'close':
+                self.close_conn = True
+                continue
+            if header[0] == 'Transfer-Encoding':
+                continue # 逐跳的头由服务器决定
+            head.append('%s: %s\r\n' % header)
+        if status[0] >= 500:
+            self.close_conn = True # 服务器出错，不再复用链接
+        handler = self.handler
+        if self.request.seq > 0:
+            handler.nr_reused += 1
+        if not self.close_conn and handler.max_keepalive_requests and self.request.seq + 1 >= handler.max_keepalive_requests:
+            self.close_conn = True # 达到单个链接的最大请求数
+            handler.nr_limit_closed += 1
+        if self.close_conn:
+            head.append('Connection: close\r\n')
+        if status[0] < 200 or status[0] in (204, 304):
+            self.has_body = False # 这些状态码不能有响应体
+        elif 'Content-Length' in self.headers:
+            pass
+        elif content_length is None:
+            self.chunked = True
+            head.append('Transfer-Encoding: chunked\r\n')
+        else:
+            # 包括重定向在内的所有响应都给出长度，客户端才能在同一链接上发送下一个请求
+            head.append('Content-Length: %d\r\n' % content_length)
+        if self.request.method == 'HEAD':
+            self.has_body = False
+        head.append('\r\n')
+        self.committed = True
+        self.sequencer.write(self.session, self.request.seq, (''.join(head).encode(),))
+    
+    def __send(self, pieces, final=False):
+        if not self.has_body:
+            return
+        if self.compressor:
+            # 每次写入都刷新压缩缓冲，流式响应的每一段都能及时到达客户端
+            compress = self.compressor.compress
+            data = b''.join([compress(piece) for piece in pieces] + [self.compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)])
+            pieces = (data,) if data else ()
+        if self.chunked:
+            outputs = []
+            [outputs.extend(encode_chunk(piece)) for piece in pieces]
+        else:
+            outputs = pieces
+        # 流水线上之前的响应还未完成时暂存在sequencer中，不反压
+        if self.sequencer.write(self.session, self.request.seq, outputs) and not self.session.wait_writable(self.handler.send_timeout):
+            raise ConnectionError('客户端[%s:%d]接收超时或已断开' % self.session.client_address)
+
 class HttpHandler:
 
-    def __init__(self, application, environ):
+    def __init__(self, application, environ, header_timeout=DEFAULT_HEADER_TIMEOUT, keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT, max_keepalive_requests=DEFAULT_MAX_KEEPALIVE_REQUESTS, stream_threshold=DEFAULT_STREAM_THRESHOLD, send_timeout=DEFAULT_SEND_TIMEOUT,
+                compress_min_size=DEFAULT_COMPRESS_MIN_SIZE, compress_types=DEFAULT_COMPRESS_TYPES, compress_level=DEFAULT_COMPRESS_LEVEL):
+        '''
+        max_keepalive_requests为单个链接最多处理的请求数，达到后响应Connection: close，None表示不限制
+        响应体超过stream_threshold字节时边产生边发送，客户端超过send_timeout秒没有接收时中止响应
+        compress_types中的响应体不小于compress_min_size字节时按Accept-Encoding压缩，compress_min_size为None表示不压缩
+        '''
         self.application = application
         self.base_env = environ
+        self.header_timeout = header_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.max_keepalive_requests = max_keepalive_requests
+        self.stream_threshold = stream_threshold
+        self.send_timeout = send_timeout
+        self.compress_min_size = compress_min_size
+        self.compress_types = compress_types
+        self.compress_level = compress_level
+        # 只做累加，不需要加锁，偶尔少计一次无关紧要
+        self.nr_reused = 0 # 复用已有链接的请求数
+        self.nr_limit_closed = 0 # 达到max_keepalive_requests而关闭的链接数
+    
+    def get_stats(self):
+        '''
+        链接复用统计，由IO处理进程定时写入统计槽位
+        '''
+        return {'reused': self.nr_reused, 'limit_closed': self.nr_limit_closed}
     
     def __process_data(self, session, data):
         env = self.base_env.copy()
@@ -193,72 +818,74 @@ class HttpHandler:
         env['wsgi.multithread'] = True
         env['wsgi.multiprocess'] = False
         env['wsgi.run_once'] = False
+        env['wsgi.file_wrapper'] = FileWrapper
         [env.update({'HTTP_' + h.upper(): data.headers[h]}) for h in data.headers]
         
-        close_conn = data.headers.get('CONNECTION')
-        close_conn = True if close_conn is not None and close_conn.lower() == 'close' else False
-        out = io.BytesIO()
-        write = lambda obj: out.write(obj) if isinstance(obj, bytes) or isinstance(obj, bytearray) else out.write(str(obj).encode())
-        outputs = []
-        status = [200, 'OK']
-        headers = {}
-        def start_response(_status, _headers, exc_info=None):
-            if _status is not None:
-                _status = _status.strip()
-                if len(_status) == 3:
-                    _status = _status + ' '
-                _status = _status.split(' ')
-                status[0] = int(_status[0])
-                status[1] = _status[1]
-            if _headers is not None:
-                [headers.update({h: _headers[h]}) for h in _headers]
-            return write
+        # 流水线上之前的请求可能还在处理，响应由sequencer按请求顺序写出
+        stream = ResponseStream(self, session, data)
         try:
-            result = self.application(env, start_response)
-            if result is not None:
-                write(result)
+            result = self.application(env, stream.start_response)
+            if isinstance(result, (bytes, bytearray, str)):
+                stream.respond(result)
+            elif result is not None:
+                # 按WSGI规范返回的可迭代对象，每个片段产生后即写出，wsgi.file_wrapper尽量以sendfile发送
+                try:
+                    if not (isinstance(result, FileWrapper) and stream.sendfile(result)):
+                        [stream.write(piece) for piece in result]
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+            stream.finish()
+        except ConnectionError as e:
+            # 客户端断开或接收超时，属于正常情况，不输出堆栈
+            logging.warning(e)
+            stream.abort()
         except Exception as e:
             logging.warn(e)
             traceback.print_exc()
-            outputs.append(('%s 500 Internal Server Error\r\nConnection: close\r\n\r\n' % SERVER_PROTOCOL_VERSION).encode())
-        else:
-            outputs.append(('%s %d %s\r\n' % (SERVER_PROTOCOL_VERSION, status[0], status[1])).encode())
-            for header in headers.items():
-                if header[0] == 'Connection' and header[1].lower() == 'close':
-                    close_conn = True
-                    continue
-                outputs.append(('%s: %s\r\n' % header).encode())
-            if status[0] >= 300:
-                close_conn = True
-            if close_conn:
-                outputs.append('Connection: close\r\n'.encode())
-            content = out.getvalue()
-            if content:
-                content_len = len(content)
-                if content_len:
-                    if not 'Content-Length' in headers:
-                        outputs.append(('Content-Length: %d\r\n\r\n' % content_len).encode())
-                    outputs.append(content)
-            else:
-                outputs.append('\r\n'.encode())
+            stream.abort()
         finally:
-            for output in outputs:
-                if output:
-                    session.write(output)
-            if close_conn:
-                session.close()
+            if data.input:
+                data.input.close() # 删除请求体的临时文件
     
     def connect(self, session):
-        logging.info('处理客户端[%s:%d]链接' % session.client_address)
+        if server.LOG_INFO:
+            logging.info('处理客户端[%s:%d]链接' % session.client_address)
+        session.set_timeout(self.header_timeout, absolute=True) # 第一个请求的请求头按header_timeout计算
         session.recv_ready()
     def recv(self, session, data):
-        logging.info('处理客户端[%s:%d]请求' % session.client_address)
+        if server.LOG_INFO:
+            logging.info('处理客户端[%s:%d]请求' % session.client_address)
         self.__process_data(session, data)
     def close(self, session):
-        logging.info('处理客户端[%s:%d]关闭' % session.client_address)
+        if server.LOG_INFO:
+            logging.info('处理客户端[%s:%d]关闭' % session.client_address)
         session.shutdown(socket.SHUT_RD)
-        session.close()
+        sequencer = session.attributes.get('sequencer')
+        if sequencer:
+            sequencer.close(session) # 已接收的请求可能还在处理，写完响应后再关闭
+        else:
+            session.close()
     def hup(self, session):
-        logging.info('处理客户端[%s:%d]强行关闭' % session.client_address)
+        if server.LOG_INFO:
+            logging.info('处理客户端[%s:%d]强行关闭' % session.client_address)
     def error(self, session):
-        logging.info('处理客户端[%s:%d]出错' % session.client_address)
+        if server.LOG_INFO:
+            logging.info('处理客户端[%s:%d]出错' % session.client_address)
+    def timeout(self, session):
+        if server.LOG_INFO:
+            logging.info('处理客户端[%s:%d]超时' % session.client_address)
+    def is_idle(self, session):
+        '''
+        IO处理进程平滑退出时调用，已完成过响应且没有正在接收的请求时可以直接关闭
+        刚建立还没有收到请求的链接需要等待，避免丢弃即将到达的第一个请求
+        '''
+        return session.attributes.get('keepalive', False) and 'decode_ctx' not in session.attributes and not session.attributes['sequencer'].is_pending()
+    def reject(self, session, data):
+        '''
+        服务器过载时在Poller线程中直接调用，快速返回503，不能阻塞
+        '''
+        logging.warn('服务器过载，拒绝客户端[%s:%d]请求' % session.client_address)
+        # 流水线上之前的请求可能还在处理，503也按请求顺序写出
+        session.attributes['sequencer'].respond(session, data.seq,
+                (('%s 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % SERVER_PROTOCOL_VERSION).encode(),), True)
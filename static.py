@@ -0,0 +1,318 @@
+'''
+静态文件
+css、js、fonts、images等目录和favicon.ico在dispatch之前直接处理，不创建Request/Response，不经过认证过滤器和Mako模板
+文件的响应头预先生成，小文件的内容一起缓存在内存中(LRU)，大文件交给服务器以sendfile发送
+可压缩的小文件在放入缓存时压缩一次，大文件使用同目录下预先压缩的.gz文件，客户端接受gzip时直接发送压缩的内容
+响应带强ETag(修改时间和长度)和Last-Modified，条件请求命中时返回304
+'''
+import collections
+import email.utils
+import gzip
+import logging
+import mimetypes
+import os
+import posixpath
+import stat
+import threading
+import time
+import server.wsgiserver as wsgiserver
+
+__all__ = ['mount', 'StaticFiles', 'is_not_modified']
+
+DEFAULT_MAX_AGE = 3600 # Cache-Control的max-age秒数，过期后浏览器以ETag重新验证
+DEFAULT_CACHE_SIZE = 16 * 1024 * 1024 # 内存缓存中文件内容的总字节数
+DEFAULT_CACHE_FILES = 1024 # 内存缓存的文件数，超过大小的文件只缓存响应头
+DEFAULT_CACHE_FILE_SIZE = 256 * 1024 # 不超过该字节数的文件连同内容一起缓存，否则以sendfile发送
+DEFAULT_CHECK_INTERVAL = 1.0 # 缓存的文件最多每隔该秒数stat一次，检查是否被修改
+DEFAULT_CHARSET = 'UTF-8' # 文本文件的字符集
+GZIP_LEVEL = 9 # 每个文件只压缩一次，使用最高压缩级别
+
+mimetypes.add_type('font/woff', '.woff')
+mimetypes.add_type('font/woff2', '.woff2')
+mimetypes.add_type('application/vnd.ms-fontobject', '.eot')
+
+class StaticFile:
+    '''
+    一个文件的元数据和预先生成的响应头，body为None表示内容不在缓存中
+    gzip_headers不为None时有压缩的版本，内容为gzip_body或.gz文件gzip_filename
+    '''
+    def __init__(self, filename, st, max_age, body=None):
+        self.filename = filename
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        self.ino = st.st_ino
+        self.body = body
+        self.checked = time.monotonic() # 最后一次确认文件未修改的时间
+        self.etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        self.mtime = st.st_mtime_ns // 1000000000 # Last-Modified只精确到秒
+        self.not_modified_headers = {
+            'ETag': self.etag,
+            'Last-Modified': email.utils.formatdate(self.mtime, usegmt=True),
+            'Cache-Control': 'public, max-age=%d' % max_age,
+        }
+        type = content_type(filename)
+        self.compressible = wsgiserver.is_compressible(type)
+        if self.compressible:
+            self.not_modified_headers['Vary'] = 'Accept-Encoding'
+        self.headers = dict(self.not_modified_headers)
+        self.headers['Content-Type'] = type
+        self.headers['Content-Length'] = str(st.st_size)
+        self.headers['Accept-Ranges'] = 'bytes' # 由服务器按Range发送区间
+        self.gzip_body = None
+        self.gzip_filename = None
+        self.gzip_headers = None
+
+    def set_gzip(self, size, body=None, filename=None):
+        self.gzip_body = body
+        self.gzip_filename = filename
+        headers = dict(self.headers)
+        del headers['Accept-Ranges'] # 区间请求按原始内容发送
+        headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(size)
+        headers['ETag'] = 'W/' + self.etag # 与原始内容不是逐字节相同
+        self.gzip_headers = headers
+
+    def memory(self):
+        '''
+        缓存中占用的字节数
+        '''
+        return (len(self.body) if self.body is not None else 0) + (len(self.gzip_body) if self.gzip_body is not None else 0)
+
+    def matches(self, st):
+        return st.st_mtime_ns == self.mtime_ns and st.st_size == self.size and st.st_ino == self.ino
+
+def content_type(filename):
+    type, encoding = mimetypes.guess_type(filename)
+    if not type:
+        return 'application/octet-stream'
+    if type.startswith('text/') or type in ('application/javascript', 'application/json', 'image/svg+xml'):
+        return '%s; charset=%s' % (type, DEFAULT_CHARSET)
+    return type
+
+def is_not_modified(if_none_match, if_modified_since, etag, mtime=None):
+    '''
+    条件请求是否命中，有If-None-Match时只比较ETag，否则以If-Modified-Since比较mtime(秒)，mtime为None时不比较
+    动态页面(webutil.check_not_modified)也使用本函数
+    '''
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        # GET/HEAD按弱比较，W/前缀不影响结果
+        weak = lambda tag: tag[2:] if tag.startswith('W/') else tag
+        return weak(etag) in (weak(tag.strip()) for tag in if_none_match.split(','))
+    if if_modified_since is not None and mtime is not None:
+        try:
+            return mtime <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError, IndexError):
+            return False # 日期格式错误时忽略
+    return False
+
+class StaticFiles:
+
+    def __init__(self, root, paths, ctx_path='', max_age=DEFAULT_MAX_AGE, cache_size=DEFAULT_CACHE_SIZE, cache_files=DEFAULT_CACHE_FILES,
+                cache_file_size=DEFAULT_CACHE_FILE_SIZE, check_interval=DEFAULT_CHECK_INTERVAL):
+        '''
+        root为静态文件的根目录，paths为静态文件的请求路径，以/结尾的是目录，否则是单个文件
+        '''
+        if not paths:
+            raise ValueError('参数[paths]不能为空')
+        self.root = os.path.realpath(root) # 与resolve()中解析了符号链接的文件名比较
+        self.paths = tuple(paths)
+        self.ctx_path = ctx_path
+        self.set_max_age(max_age)
+        self.set_cache_size(cache_size)
+        self.set_cache_files(cache_files)
+        self.set_cache_file_size(cache_file_size)
+        self.check_interval = check_interval
+        self.__cache = collections.OrderedDict() # 文件名 -> StaticFile，按最近使用排序
+        self.__cached_size = 0 # 缓存中文件内容的总字节数
+        self.__lock = threading.Lock() # 多个Executor线程同时访问缓存
+
+    def set_max_age(self, max_age):
+        if max_age < 0:
+            raise ValueError('参数[max_age]不能小于0')
+        self.max_age = max_age
+
+    def set_cache_size(self, cache_size):
+        if cache_size < 0:
+            raise ValueError('参数[cache_size]不能小于0')
+        self.cache_size = cache_size
+
+    def set_cache_files(self, cache_files):
+        if cache_files < 0:
+            raise ValueError('参数[cache_files]不能小于0')
+        self.cache_files = cache_files
+
+    def set_cache_file_size(self, cache_file_size):
+        if cache_file_size < 0:
+            raise ValueError('参数[cache_file_size]不能小于0')
+        self.cache_file_size = cache_file_size
+
+    def resolve(self, path):
+        '''
+        请求路径对应的文件名，不是静态文件的路径返回None，超出根目录的路径返回空字符串
+        '''
+        if self.ctx_path:
+            if not path.startswith(self.ctx_path):
+                return None
+            path = path[len(self.ctx_path):]
+        # 先消除..再匹配，/css/../x不能借css目录访问其它文件
+        path = posixpath.normpath(path)
+        if not any(path == p or p.endswith('/') and path.startswith(p) for p in self.paths):
+            return None
+        # 解析符号链接之后仍要在根目录下，指向根目录之外的链接不能访问
+        filename = os.path.realpath(os.path.join(self.root, path.lstrip('/')))
+        return filename if filename.startswith(self.root + os.sep) else ''
+
+    def serve(self, env, start_response):
+        '''
+        不是静态文件的请求返回None，由之后的application处理
+        '''
+        filename = self.resolve(env['PATH_INFO'])
+        if filename is None:
+            return None
+        if env['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', {'Allow': 'GET, HEAD', 'Content-Length': '0'})
+            return b''
+        file = self.__get(filename) if filename else None
+        if file is None:
+            return self.__not_found(env, start_response)
+        if is_not_modified(env.get('HTTP_IF-NONE-MATCH'), env.get('HTTP_IF-MODIFIED-SINCE'), file.etag, file.mtime):
+            start_response('304 Not Modified', file.not_modified_headers)
+            return b''
+        # 区间请求按原始内容处理
+        if file.gzip_headers is not None and 'HTTP_RANGE' not in env and wsgiserver.choose_encoding(env.get('HTTP_ACCEPT-ENCODING'), ('gzip',)):
+            if file.gzip_body is not None:
+                start_response('200 OK', file.gzip_headers)
+                return file.gzip_body
+            if file.gzip_filename is not None:
+                # .gz文件比原文件旧说明已过期，不使用
+                result = self.__send_file(env, start_response, file.gzip_filename,
+                        lambda st: file.gzip_headers if st.st_mtime_ns >= file.mtime_ns and str(st.st_size) == file.gzip_headers['Content-Length'] else None)
+                if result is not None:
+                    return result
+        if file.body is not None:
+            start_response('200 OK', file.headers)
+            return file.body
+        # stat之后文件被替换时以打开的文件为准
+        result = self.__send_file(env, start_response, filename, lambda st: file.headers if file.matches(st) else StaticFile(filename, st, self.max_age).headers)
+        return result if result is not None else self.__not_found(env, start_response)
+
+    def __send_file(self, env, start_response, filename, get_headers):
+        '''
+        打开文件交给服务器以sendfile发送，get_headers(st)返回响应头，返回None表示不使用该文件
+        '''
+        try:
+            f = open(filename, 'rb')
+        except OSError:
+            return None
+        try:
+            headers = get_headers(os.fstat(f.fileno()))
+            if headers is None:
+                f.close()
+                return None
+            start_response('200 OK', headers)
+            file_wrapper = env.get('wsgi.file_wrapper')
+            if file_wrapper:
+                return file_wrapper(f)
+            body = f.read()
+        except Exception:
+            f.close()
+            raise
+        f.close()
+        return body
+
+    def __not_found(self, env, start_response):
+        body = ('您请求的资源[%s]不存在' % env['PATH_INFO']).encode(DEFAULT_CHARSET)
+        start_response('404 Not Found', {'Content-Type': 'text/plain; charset=%s' % DEFAULT_CHARSET, 'Content-Length': str(len(body))})
+        return body
+
+    def __get(self, filename):
+        '''
+        缓存中的文件在check_interval内直接使用，否则stat确认未修改；文件不存在返回None
+        '''
+        now = time.monotonic()
+        with self.__lock:
+            file = self.__cache.get(filename)
+            if file is not None:
+                self.__cache.move_to_end(filename)
+                if now - file.checked < self.check_interval:
+                    return file
+        try:
+            st = os.stat(filename)
+        except (OSError, ValueError):
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            self.__remove(filename)
+            return None
+        if file is not None and file.matches(st):
+            file.checked = now
+            return file
+        body = None
+        if st.st_size <= self.cache_file_size:
+            try:
+                with open(filename, 'rb') as f:
+                    st = os.fstat(f.fileno())
+                    body = f.read()
+            except OSError as e:
+                logging.warning(e)
+                self.__remove(filename)
+                return None
+            if len(body) != st.st_size:
+                body = None # 读取期间文件被修改，本次不缓存内容
+        file = StaticFile(filename, st, self.max_age, body)
+        if file.compressible:
+            self.__prepare_gzip(file, st)
+        self.__put(filename, file)
+        return file
+
+    def __prepare_gzip(self, file, st):
+        '''
+        缓存了内容的文件压缩一次，压缩后变小才使用；否则找同目录下不比原文件旧的.gz文件
+        '''
+        if file.body is not None:
+            gzip_body = gzip.compress(file.body, GZIP_LEVEL, mtime=0)
+            if len(gzip_body) < len(file.body):
+                file.set_gzip(len(gzip_body), body=gzip_body)
+            return
+        try:
+            gzip_st = os.stat(file.filename + '.gz')
+        except OSError:
+            return
+        if stat.S_ISREG(gzip_st.st_mode) and gzip_st.st_mtime_ns >= st.st_mtime_ns:
+            file.set_gzip(gzip_st.st_size, filename=file.filename + '.gz')
+
+    def __put(self, filename, file):
+        with self.__lock:
+            old = self.__cache.pop(filename, None)
+            if old is not None:
+                self.__cached_size -= old.memory()
+            if file.memory() > self.cache_size:
+                file.body = None
+                if file.gzip_body is not None:
+                    file.gzip_body = None
+                    file.gzip_headers = None
+            self.__cache[filename] = file
+            self.__cached_size += file.memory()
+            # 淘汰最久未使用的文件
+            while self.__cache and (self.__cached_size > self.cache_size or len(self.__cache) > self.cache_files):
+                name, old = self.__cache.popitem(last=False)
+                self.__cached_size -= old.memory()
+
+    def __remove(self, filename):
+        with self.__lock:
+            old = self.__cache.pop(filename, None)
+            if old is not None:
+                self.__cached_size -= old.memory()
+
+def mount(root, paths, ctx_path='', **options):
+    '''
+    静态文件挂在application之前，与过滤器的装饰器用法一致
+    '''
+    static_files = StaticFiles(root, paths, ctx_path, **options)
+    def interceptor(func):
+        def wrap(env, start_response):
+            result = static_files.serve(env, start_response)
+            return func(env, start_response) if result is None else result
+        return wrap
+    return interceptor
@@ -1,10 +1,17 @@
 import urllib.parse
+import email.utils
+import hashlib
 import time
 import config
+import static
 from mako.lookup import TemplateLookup
 import security.authholder as authholder
 
-__all__ = ['merge', 'render']
+__all__ = ['merge', 'render', 'is_not_modified', 'check_not_modified']
+
+# 进程启动(包括SIGHUP重启)时生成，参与动态页面的ETag，部署新的代码或模板后旧页面的ETag全部失效
+# 在主进程导入时生成，Fork出的IO处理进程相同
+BUILD_TOKEN = '%x' % time.time_ns()
 
 lookup = TemplateLookup(directories=[config.install_path + '/template'], input_encoding=config.encoding)
 
@@ -18,4 +25,28 @@ def merge(template, data, request):
     return template.render(**data)
 
 def render(template, data, request, response):
-    response.write(merge(template, data, request))
\ No newline at end of file
+    response.write(merge(template, data, request))
+
+def is_not_modified(request, etag, last_modified=None):
+    '''
+    请求的If-None-Match/If-Modified-Since是否与etag、last_modified(秒)一致
+    '''
+    return static.is_not_modified(request.get_header('IF-NONE-MATCH'), request.get_header('IF-MODIFIED-SINCE'), etag, last_modified)
+
+def check_not_modified(request, response, version, last_modified=None):
+    '''
+    处理器在查询数据、渲染页面之前调用，version为页面所依赖数据的版本，数据不变时version不变
+    页面中还有当前用户的信息，ETag由version、登录用户和BUILD_TOKEN共同决定
+    返回True时已设置304，处理器直接返回，不再渲染
+    '''
+    auth = authholder.get()
+    digest = hashlib.md5(('%s:%s:%s' % (BUILD_TOKEN, version, auth.get_name() if auth else '')).encode(config.encoding)).hexdigest()
+    etag = 'W/"%s"' % digest # 只保证内容等价，不保证逐字节相同
+    response.set_header('ETag', etag)
+    response.set_header('Cache-Control', 'private, no-cache')
+    if last_modified is not None:
+        response.set_header('Last-Modified', email.utils.formatdate(last_modified, usegmt=True))
+    if request.get_method() in ('GET', 'HEAD') and is_not_modified(request, etag, last_modified):
+        response.set_status(304)
+        return True
+    return False
\ No newline at end of file